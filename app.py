@@ -1,13 +1,3 @@
-import subprocess
-import jinja2
-import gradio
-import matplotlib.pyplot as plt
-import numpy as np
-import base64
-from io import BytesIO
-
-subprocess.run(
-        ["curl", "--output", "checkpoint.pkl", "https://storage.googleapis.com/ithaca-resources/models/checkpoint_v1.pkl"])
 # Copyright 2021 the Ithaca Authors
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -22,16 +12,50 @@ subprocess.run(
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Example for running inference. See also colab."""
-import functools
-import pickle
+import base64
+from io import BytesIO
+import os
+
+from absl import logging
+from ithaca.eval import startup
+
+CHECKPOINT_URL = 'https://storage.googleapis.com/ithaca-resources/models/checkpoint_v1.pkl'
+# Expected SHA-256 of the checkpoint at CHECKPOINT_URL; overridden by
+# ITHACA_CHECKPOINT_SHA256. Without one, the first download is trusted.
+CHECKPOINT_SHA256 = None
 
-from ithaca.eval import inference
-from ithaca.models.model import Model
-from ithaca.util.alphabet import GreekAlphabet
-import jax
+
+def _on_ready(model):
+  from ithaca.eval import batching
+  from ithaca.eval import compile_cache
+  logging.info('Compile cache after warm-up: %s.', compile_cache.stats())
+  # Attributions and restoration forward calls of concurrent requests are
+  # batched together.
+  attribute = batching.BatchingAttribution(
+      model.forward,
+      params=model.params,
+      alphabet=model.alphabet,
+      vocab_char_size=model.vocab_char_size,
+      vocab_word_size=model.vocab_word_size,
+      region_map=model.region_map)
+  return model, batching.BatchingForward(model.forward), attribute
+
+
+# Heavy modules (JAX, matplotlib, jinja2) are imported where first used, so
+# that the server and health check start while the model loads.
+loader = startup.ModelLoader(
+    'ithaca',
+    CHECKPOINT_URL,
+    cache_dir=os.environ.get('ITHACA_CACHE_DIR', 'checkpoints'),
+    sha256=os.environ.get('ITHACA_CHECKPOINT_SHA256', CHECKPOINT_SHA256),
+    compile_cache_dir='compile_cache',
+    on_ready=_on_ready)
 
 
 def create_time_plot(attribution):
+    import matplotlib.pyplot as plt
+    import numpy as np
+
     class dataset_config:
       date_interval = 10
       date_max = 800
@@ -83,42 +107,10 @@ def create_time_plot(attribution):
 def get_subregion_name(id, region_map):
   return region_map['sub']['names_inv'][region_map['sub']['ids_inv'][id]]
 
-def load_checkpoint(path):
-  """Loads a checkpoint pickle.
-
-  Args:
-    path: path to checkpoint pickle
-
-  Returns:
-    a model config dictionary (arguments to the model's constructor), a dict of
-    dicts containing region mapping information, a GreekAlphabet instance with
-    indices and words populated from the checkpoint, a dict of Jax arrays
-    `params`, and a `forward` function.
-  """
-
-  # Pickled checkpoint dict containing params and various config:
-  with open(path, 'rb') as f:
-    checkpoint = pickle.load(f)
-
-  # We reconstruct the model using the same arguments as during training, which
-  # are saved as a dict in the "model_config" key, and construct a `forward`
-  # function of the form required by attribute() and restore().
-  params = jax.device_put(checkpoint['params'])
-  model = Model(**checkpoint['model_config'])
-  forward = functools.partial(model.apply, params)
-
-  # Contains the mapping between region IDs and names:
-  region_map = checkpoint['region_map']
-
-  # Use vocabulary mapping from the checkpoint, the rest of the values in the
-  # class are fixed and constant e.g. the padding symbol
-  alphabet = GreekAlphabet()
-  alphabet.idx2word = checkpoint['alphabet']['idx2word']
-  alphabet.word2idx = checkpoint['alphabet']['word2idx']
-
-  return checkpoint['model_config'], region_map, alphabet, params, forward
-
 def main(text):
+  import jinja2
+  from ithaca.eval import inference
+
   restore_template = jinja2.Template("""<!DOCTYPE html>
     <html>
     <head>
@@ -232,21 +224,16 @@ def main(text):
         f'Text should be between 50 and 750 chars long, but the input was '
         f'{len(input_text)} characters')
 
-  # Load the checkpoint pickle and extract from it the pieces needed for calling
-  # the attribute() and restore() functions:
-  (model_config, region_map, alphabet, params,
-   forward) = load_checkpoint('checkpoint.pkl')
-  vocab_char_size = model_config['vocab_char_size']
-  vocab_word_size = model_config['vocab_word_size']
+  # The checkpoint is loaded once per process; every request shares the same
+  # params, and the work of concurrent requests is batched together.
+  model, forward, attribute = loader.wait()
+  params = model.params
+  alphabet = model.alphabet
+  region_map = model.region_map
+  vocab_char_size = model.vocab_char_size
+  vocab_word_size = model.vocab_word_size
 
-  attribution = inference.attribute(
-      text,
-      forward=forward,
-      params=params,
-      alphabet=alphabet,
-      region_map=region_map,
-      vocab_char_size=vocab_char_size,
-      vocab_word_size=vocab_word_size)
+  attribution = attribute(text)
 
   restoration = inference.restore(
       text,
@@ -262,6 +249,12 @@ def main(text):
           restoration_results=restoration,
           prediction_idx=prediction_idx), attrib_dict, create_time_plot(attribution)
 
+loader.start()
+startup.serve_health(loader, int(os.environ.get('ITHACA_HEALTH_PORT', 8081)))
+
+with loader.timer.phase('gradio'):
+  import gradio
+
 with open('example_input.txt', encoding='utf8') as f:
     examples = [line for line in f]
 gradio.Interface(
@@ -0,0 +1,246 @@
+# Copyright 2021 the Ithaca Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Bulk attribution and restoration of a corpus of inscriptions.
+
+Reads a text file (one inscription per line) or a JSONL file (one object with a
+`text` and optional `id` field per line) and writes one JSON line per input
+with the `build_json()` output of attribute() and/or restore():
+
+  ithaca-batch --input=corpus.jsonl --output=results.jsonl \
+      --checkpoint=checkpoint.pkl --tasks=attribute,restore --num_workers=4
+
+The input is sharded round-robin over `num_workers` local processes, each of
+which appends its results to its own shard file as it goes. A job that is
+killed resumes where every shard stopped when rerun with the same flags. Once
+all shards are complete they are merged into `output` in input order.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from absl import app
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('input', None, 'Input .txt or .jsonl file.')
+flags.DEFINE_string('output', None, 'Output .jsonl file.')
+flags.DEFINE_string('checkpoint', 'checkpoint.pkl', 'Model checkpoint.')
+flags.DEFINE_list('tasks', ['attribute'], 'attribute and/or restore.')
+flags.DEFINE_integer('batch_size', 32,
+                     'Texts read at a time and per attribution batch.')
+flags.DEFINE_integer('num_workers', 1, 'Number of worker processes.')
+flags.DEFINE_string('compile_cache_dir', None,
+                    'Persistent compilation cache shared by the workers.')
+
+TASKS = ('attribute', 'restore')
+
+
+def read_inputs(path: str) -> Iterator[Tuple[int, Any, str]]:
+  """Yields (index, id, text) for every line of a .txt or .jsonl file.
+
+  Blank lines of a .jsonl file are skipped; `index` is still the line number.
+  """
+  is_jsonl = path.endswith('.jsonl')
+  with open(path, encoding='utf8') as f:
+    for index, line in enumerate(f):
+      line = line.rstrip('\n')
+      if is_jsonl:
+        if not line.strip():
+          continue
+        record = json.loads(line)
+        yield index, record.get('id', index), record['text']
+      else:
+        yield index, index, line
+
+
+def shard_path(output: str, shard: int, num_shards: int) -> str:
+  return f'{output}-{shard:05d}-of-{num_shards:05d}'
+
+
+def _completed_lines(path: str) -> int:
+  """Returns the number of complete lines, dropping a partial last line."""
+  if not os.path.exists(path):
+    return 0
+  with open(path, 'rb+') as f:
+    data = f.read()
+    complete = data.rfind(b'\n') + 1
+    if complete < len(data):
+      f.truncate(complete)
+  return data.count(b'\n', 0, complete)
+
+
+def _error_message(e: Exception) -> str:
+  if isinstance(e, KeyError):
+    return f'Unknown character {e}.'
+  return str(e)
+
+
+def _process_batch(batch, model, tasks,
+                   batch_size: int) -> Iterator[Dict[str, Any]]:
+  """Runs the tasks on a batch of (index, id, text).
+
+  A text that cannot be processed, e.g. because it is too short or has a
+  character outside the alphabet, gets an `error` field instead of failing
+  the batch.
+  """
+  # Imported here so that the main process does not initialize JAX.
+  from ithaca.eval import inference  # pylint: disable=g-import-not-at-top
+
+  model_kwargs = dict(
+      forward=model.forward,
+      params=model.params,
+      alphabet=model.alphabet,
+      vocab_char_size=model.vocab_char_size,
+      vocab_word_size=model.vocab_word_size)
+  attributions = [None] * len(batch)
+  if 'attribute' in tasks:
+    attributions = inference.attribute_batch(
+        [text for _, _, text in batch],
+        region_map=model.region_map,
+        batch_size=batch_size,
+        **model_kwargs)
+
+  for (index, record_id, text), attribution in zip(batch, attributions):
+    record = {'index': index, 'id': record_id}
+    errors = []
+    if 'attribute' in tasks:
+      if attribution is None:
+        # attribute_batch() skips texts it cannot prepare; attributing the
+        # text alone reports why.
+        try:
+          attribution = inference.attribute(
+              text, region_map=model.region_map, **model_kwargs)
+        except (KeyError, ValueError) as e:
+          errors.append(_error_message(e))
+      record['attribution'] = attribution and attribution.build_json()
+    if 'restore' in tasks:
+      record['restoration'] = None
+      if inference.ALPHABET_MISSING_RESTORE in text:
+        try:
+          record['restoration'] = inference.restore(
+              text, **model_kwargs).build_json()
+        except (KeyError, ValueError) as e:
+          errors.append(_error_message(e))
+    if errors:
+      record['error'] = ' '.join(dict.fromkeys(errors))
+    yield record
+
+
+def run_shard(input_path: str, output: str, checkpoint: str, tasks,
+              batch_size: int, shard: int, num_shards: int,
+              compile_cache_dir: Optional[str] = None) -> Tuple[int, float]:
+  """Processes one shard, resuming after its completed lines.
+
+  Returns:
+    The number of texts processed by this call and the time it took.
+  """
+  # pylint: disable=g-import-not-at-top
+  from ithaca.eval import compile_cache
+  from ithaca.eval import registry
+  # pylint: enable=g-import-not-at-top
+
+  if compile_cache_dir is not None:
+    compile_cache.enable(compile_cache_dir)
+  path = shard_path(output, shard, num_shards)
+  done = _completed_lines(path)
+  inputs = itertools.islice(read_inputs(input_path), shard, None, num_shards)
+  inputs = itertools.islice(inputs, done, None)
+
+  model = registry.get(checkpoint)
+  start = time.time()
+  processed = 0
+  with open(path, 'a', encoding='utf8') as f:
+    while True:
+      batch = list(itertools.islice(inputs, batch_size))
+      if not batch:
+        break
+      for record in _process_batch(batch, model, tasks, batch_size):
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+      # Results of a batch are durable before the next one starts.
+      f.flush()
+      os.fsync(f.fileno())
+      processed += len(batch)
+      elapsed = time.time() - start
+      logging.info('Shard %d: %d texts (%d resumed), %.2f texts/s.', shard,
+                   done + processed, done, processed / elapsed)
+  if compile_cache_dir is not None:
+    logging.info('Shard %d compile cache: %s.', shard, compile_cache.stats())
+  return processed, time.time() - start
+
+
+def _run_shard_star(args):
+  return run_shard(*args)
+
+
+def merge_shards(output: str, num_shards: int) -> int:
+  """Interleaves the shard files into `output` in input order."""
+  shard_files = [
+      open(shard_path(output, i, num_shards), encoding='utf8')
+      for i in range(num_shards)
+  ]
+  count = 0
+  with open(output, 'w', encoding='utf8') as f:
+    for lines in itertools.zip_longest(*shard_files):
+      for line in lines:
+        if line is not None:
+          f.write(line)
+          count += 1
+  for shard_file in shard_files:
+    shard_file.close()
+  for i in range(num_shards):
+    os.remove(shard_path(output, i, num_shards))
+  return count
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+  if not FLAGS.input or not FLAGS.output:
+    raise app.UsageError('--input and --output are required.')
+  tasks = set(FLAGS.tasks)
+  if not tasks or not tasks <= set(TASKS):
+    raise app.UsageError(f'--tasks must be a subset of {TASKS}.')
+
+  num_shards = FLAGS.num_workers
+  shard_args = [(FLAGS.input, FLAGS.output, FLAGS.checkpoint, tasks,
+                 FLAGS.batch_size, shard, num_shards, FLAGS.compile_cache_dir)
+                for shard in range(num_shards)]
+  start = time.time()
+  if num_shards == 1:
+    results = [run_shard(*shard_args[0])]
+  else:
+    # JAX is not fork-safe; workers start from a fresh interpreter.
+    with multiprocessing.get_context('spawn').Pool(num_shards) as pool:
+      results = pool.map(_run_shard_star, shard_args)
+  elapsed = time.time() - start
+
+  processed = sum(n for n, _ in results)
+  count = merge_shards(FLAGS.output, num_shards)
+  logging.info('Processed %d texts in %.1fs (%.2f texts/s); wrote %d to %s.',
+               processed, elapsed, processed / max(elapsed, 1e-9), count,
+               FLAGS.output)
+
+
+def run():
+  app.run(main)
+
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,239 @@
+# Copyright 2021 the Ithaca Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Dynamic micro-batching of forward calls from concurrent requests.
+
+`BatchingForward` wraps a `forward` function (usually an
+`engine.InferenceEngine`) and can be passed anywhere a `forward` is expected.
+Calls from different threads are queued; a scheduler thread waits up to
+`max_wait_ms` after the first queued call for more calls, concatenates the
+inputs of compatible calls along the batch dimension (up to `max_batch_size`
+rows), runs one forward pass and hands each caller its rows of the outputs.
+
+Calls are compatible if they pass the same keyword arguments with the same
+per-row shapes and dtypes, and the same static arguments (`is_training`,
+`outputs`) and dropout rng. Calls made while tracing cannot be deferred and
+run directly. These include every forward pass of attribute() and of the
+restoration saliency maps, which are differentiated, so `BatchingForward`
+only batches the steps of the host beam searches.
+
+`BatchingAttribution` batches attribution instead: it queues whole attribute()
+requests and runs each group through `inference.attribute_batch()`, with one
+forward and backward pass for all texts of the same padded length.
+"""
+
+import concurrent.futures
+import threading
+import time
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence
+
+import jax
+import numpy as np
+
+
+class _Call(NamedTuple):
+  key: Any
+  inputs: Any
+  batch_size: int
+  future: concurrent.futures.Future
+
+
+def _is_tracer(x) -> bool:
+  return isinstance(x, jax.core.Tracer)
+
+
+class _Scheduler:
+  """Queue of calls, run in groups of compatible ones by a scheduler thread.
+
+  Attributes:
+    max_batch_size: maximum number of rows per group.
+    max_wait_ms: how long the first queued call waits for others.
+  """
+
+  def __init__(self, max_batch_size: int, max_wait_ms: float):
+    self.max_batch_size = max_batch_size
+    self.max_wait_ms = max_wait_ms
+    self._cond = threading.Condition()
+    self._queue: List[_Call] = []
+    self._closed = False
+    self._thread = threading.Thread(
+        target=self._run, name=type(self).__name__, daemon=True)
+    self._thread.start()
+
+  def _submit(self, call: _Call) -> Any:
+    """Queues `call` and waits for its result."""
+    with self._cond:
+      if self._closed:
+        raise RuntimeError(f'{type(self).__name__} is closed.')
+      self._queue.append(call)
+      self._cond.notify()
+    return call.future.result()
+
+  def _take_batch(self) -> Optional[List[_Call]]:
+    """Waits for calls and returns a group of compatible ones."""
+    with self._cond:
+      while not self._queue:
+        if self._closed:
+          return None
+        self._cond.wait()
+      deadline = time.monotonic() + self.max_wait_ms / 1000.
+      while True:
+        key = self._queue[0].key
+        rows = sum(c.batch_size for c in self._queue if c.key == key)
+        remaining = deadline - time.monotonic()
+        if rows >= self.max_batch_size or remaining <= 0 or self._closed:
+          break
+        self._cond.wait(remaining)
+
+      batch, rest, rows = [], [], 0
+      for call in self._queue:
+        if call.key == key and rows + call.batch_size <= self.max_batch_size:
+          batch.append(call)
+          rows += call.batch_size
+        else:
+          rest.append(call)
+      self._queue = rest
+      return batch
+
+  def _run_batch(self, batch: List[_Call]) -> List[Any]:
+    """Returns the result of every call of a group."""
+    raise NotImplementedError()
+
+  def _run(self):
+    while True:
+      batch = self._take_batch()
+      if batch is None:
+        return
+      try:
+        results = self._run_batch(batch)
+      except Exception as e:  # pylint: disable=broad-except
+        for call in batch:
+          call.future.set_exception(e)
+        continue
+      for call, result in zip(batch, results):
+        call.future.set_result(result)
+
+  def close(self) -> None:
+    """Runs the queued calls and stops the scheduler thread."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    self._thread.join()
+
+
+class BatchingForward(_Scheduler):
+  """Callable with the signature of `forward` that batches concurrent calls.
+
+  Attributes:
+    forward: the wrapped forward function.
+    max_batch_size: maximum number of rows per coalesced forward pass.
+    max_wait_ms: how long the first queued call waits for others.
+  """
+
+  def __init__(self,
+               forward: Callable[..., Any],
+               max_batch_size: int = 32,
+               max_wait_ms: float = 5.):
+    self.forward = forward
+    super().__init__(max_batch_size, max_wait_ms)
+
+  def __call__(self, *, rngs=None, is_training=False, outputs=None, **kwargs):
+    arrays = {k: v for k, v in kwargs.items() if v is not None}
+    if not arrays:
+      raise ValueError('Wrong inputs.')
+    if (is_training or any(_is_tracer(v) for v in arrays.values()) or
+        any(_is_tracer(v) for v in jax.tree_util.tree_leaves(rngs))):
+      return self.forward(
+          rngs=rngs, is_training=is_training, outputs=outputs, **kwargs)
+
+    inputs = {k: np.asarray(v) for k, v in arrays.items()}
+    batch_size = next(iter(inputs.values())).shape[0]
+    if batch_size >= self.max_batch_size:
+      return self.forward(
+          rngs=rngs, is_training=is_training, outputs=outputs, **kwargs)
+
+    key = (tuple((k, v.shape[1:], v.dtype.str)
+                 for k, v in sorted(inputs.items())),
+           tuple(sorted(outputs)) if outputs is not None else None,
+           tuple(np.asarray(leaf).tobytes()
+                 for leaf in jax.tree_util.tree_leaves(rngs)))
+    return self._submit(
+        _Call(key, dict(inputs, rngs=rngs), batch_size,
+              concurrent.futures.Future()))
+
+  def _run_batch(self, batch: List[_Call]) -> List[Any]:
+    names = [k for k in batch[0].inputs if k != 'rngs']
+    inputs = {k: np.concatenate([c.inputs[k] for c in batch]) for k in names}
+    outputs = batch[0].key[1]
+    results = self.forward(
+        rngs=batch[0].inputs['rngs'],
+        is_training=False,
+        outputs=outputs,
+        **inputs)
+    results = jax.device_get(results)
+
+    split, start = [], 0
+    for call in batch:
+      end = start + call.batch_size
+      split.append(
+          jax.tree_util.tree_map(lambda x, s=start, e=end: x[s:e], results))
+      start = end
+    return split
+
+
+class BatchingAttribution(_Scheduler):
+  """Computes attribute() of concurrent requests in batches.
+
+  Attributes:
+    max_batch_size: maximum number of texts per attribute_batch() call.
+    max_wait_ms: how long the first queued text waits for others.
+  """
+
+  def __init__(self,
+               forward: Callable[..., Any],
+               params,
+               alphabet,
+               vocab_char_size: int,
+               vocab_word_size: int,
+               region_map,
+               length_buckets: Optional[Sequence[int]] = None,
+               max_batch_size: int = 8,
+               max_wait_ms: float = 5.):
+    """Creates the scheduler, with the arguments of attribute()."""
+    self._kwargs = dict(
+        forward=forward,
+        params=params,
+        alphabet=alphabet,
+        vocab_char_size=vocab_char_size,
+        vocab_word_size=vocab_word_size,
+        region_map=region_map,
+        length_buckets=length_buckets)
+    super().__init__(max_batch_size, max_wait_ms)
+
+  def __call__(self, text: str):
+    """Returns attribute(text), computed together with concurrent calls."""
+    # Imported here, as inference imports the modules that use this one.
+    from ithaca.eval import inference  # pylint: disable=g-import-not-at-top
+
+    results = self._submit(_Call(None, text, 1, concurrent.futures.Future()))
+    if results is None:
+      # attribute_batch() skipped the text; attribute() raises the reason.
+      results = inference.attribute(text, **self._kwargs)
+    return results
+
+  def _run_batch(self, batch: List[_Call]) -> List[Any]:
+    from ithaca.eval import inference  # pylint: disable=g-import-not-at-top
+
+    return inference.attribute_batch([call.inputs for call in batch],
+                                     batch_size=self.max_batch_size,
+                                     **self._kwargs)
@@ -0,0 +1,185 @@
+# Copyright 2021 the Ithaca Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Content-addressed cache of attribute() and restore() results.
+
+Results are keyed by a hash of the model identity, the kind of result, the
+normalized input text and the decoding parameters, so that resubmissions of
+the same inscription (differing only in whitespace or accents) are answered
+without running the model. Entries are kept in a bounded in-memory LRU, and
+optionally in an SQLite database that survives restarts and can be shared by
+several processes.
+
+Typical use:
+
+  results_cache = cache.ResultCache(model_id='ithaca', path='results.sqlite')
+  inference.attribute(text, ..., cache=results_cache)
+"""
+
+import collections
+import hashlib
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, NamedTuple, Optional
+
+
+class CacheStats(NamedTuple):
+  """Counters of a ResultCache since creation or the last reset."""
+
+  memory_hits: int
+  disk_hits: int
+  misses: int
+  evictions: int  # entries dropped from the memory tier
+  disk_evictions: int
+
+  @property
+  def hits(self) -> int:
+    return self.memory_hits + self.disk_hits
+
+  @property
+  def hit_rate(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.
+
+
+class ResultCache:
+  """Two-tier (memory LRU and optional SQLite) cache of inference results.
+
+  Cached values are returned as stored, and must not be modified by callers.
+  """
+
+  def __init__(self,
+               model_id: str,
+               max_entries: int = 1024,
+               path: Optional[str] = None,
+               max_disk_entries: Optional[int] = 100000):
+    """Creates the cache.
+
+    Args:
+      model_id: identity of the model, e.g. its name or checkpoint path;
+        results of different models never share keys.
+      max_entries: capacity of the in-memory tier.
+      path: optional SQLite database file of the on-disk tier.
+      max_disk_entries: capacity of the on-disk tier, None for unbounded.
+    """
+    self.model_id = model_id
+    self.max_entries = max_entries
+    self.max_disk_entries = max_disk_entries
+    self._lock = threading.Lock()
+    self._memory = collections.OrderedDict()
+    self._db = None
+    if path is not None:
+      self._db = sqlite3.connect(path, check_same_thread=False)
+      with self._db:
+        self._db.execute('CREATE TABLE IF NOT EXISTS results ('
+                         'key TEXT PRIMARY KEY, value BLOB, accessed REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_accessed '
+                         'ON results (accessed)')
+    self.reset_stats()
+
+  def key(self, kind: str, text: str, **params) -> str:
+    """Returns the key of a result for the normalized `text`.
+
+    Args:
+      kind: kind of result, e.g. 'attribute' or 'restore'.
+      text: normalized input text.
+      **params: decoding parameters that affect the result (JSON serializable).
+    """
+    content = json.dumps([self.model_id, kind, text, params],
+                         sort_keys=True,
+                         ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+  def get(self, key: str) -> Optional[Any]:
+    """Returns the cached value, or None."""
+    with self._lock:
+      value = self._memory.get(key)
+      if value is not None:
+        self._memory.move_to_end(key)
+        self._memory_hits += 1
+        return value
+
+      if self._db is not None:
+        row = self._db.execute('SELECT value FROM results WHERE key = ?',
+                               (key,)).fetchone()
+        if row is not None:
+          with self._db:
+            self._db.execute('UPDATE results SET accessed = ? WHERE key = ?',
+                             (time.time(), key))
+          value = pickle.loads(row[0])
+          self._put_memory(key, value)
+          self._disk_hits += 1
+          return value
+
+      self._misses += 1
+      return None
+
+  def put(self, key: str, value: Any) -> None:
+    """Stores `value` under `key` in all tiers."""
+    with self._lock:
+      self._put_memory(key, value)
+      if self._db is not None:
+        with self._db:
+          self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                           (key, pickle.dumps(value), time.time()))
+          if self.max_disk_entries is not None:
+            # Drop the least recently used entries over capacity.
+            evicted = self._db.execute(
+                'DELETE FROM results WHERE key IN (SELECT key FROM results '
+                'ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                (self.max_disk_entries,)).rowcount
+            self._disk_evictions += max(evicted, 0)
+
+  def _put_memory(self, key, value):
+    self._memory[key] = value
+    self._memory.move_to_end(key)
+    while len(self._memory) > self.max_entries:
+      self._memory.popitem(last=False)
+      self._evictions += 1
+
+  def stats(self) -> CacheStats:
+    with self._lock:
+      return CacheStats(
+          memory_hits=self._memory_hits,
+          disk_hits=self._disk_hits,
+          misses=self._misses,
+          evictions=self._evictions,
+          disk_evictions=self._disk_evictions)
+
+  def reset_stats(self) -> None:
+    self._memory_hits = 0
+    self._disk_hits = 0
+    self._misses = 0
+    self._evictions = 0
+    self._disk_evictions = 0
+
+  def __len__(self) -> int:
+    with self._lock:
+      return len(self._memory)
+
+  def clear(self) -> None:
+    """Removes all entries from both tiers."""
+    with self._lock:
+      self._memory.clear()
+      if self._db is not None:
+        with self._db:
+          self._db.execute('DELETE FROM results')
+
+  def close(self) -> None:
+    with self._lock:
+      if self._db is not None:
+        self._db.close()
+        self._db = None
@@ -0,0 +1,184 @@
+# Copyright 2021 the Ithaca Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Memory-mapped checkpoint directory format.
+
+A checkpoint directory holds two files:
+
+  manifest.json: `model_config`, `region_map` and the alphabet vocabulary,
+    and the key path, dtype, shape and byte offset of every parameter.
+  params.bin: the raw little-endian parameter arrays, each starting at a
+    multiple of 64 bytes.
+
+Loading maps `params.bin` read-only and returns the parameters as views of
+the mapping, so nothing is read until it is used and all processes loading
+the same directory share one copy in the page cache. Convert a pickled
+checkpoint with:
+
+  python -m ithaca.eval.checkpoint_dir checkpoint.pkl checkpoint
+"""
+
+import json
+import mmap
+import os
+import pickle
+from typing import Any, Dict, Mapping
+
+from absl import app
+
+import numpy as np
+
+MANIFEST = 'manifest.json'
+PARAMS = 'params.bin'
+FORMAT_VERSION = 1
+ALIGNMENT = 64  # bytes
+
+
+def is_checkpoint_dir(path: str) -> bool:
+  return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def _encode(value):
+  """Makes `value` JSON serializable, keeping non-string dict keys."""
+  if isinstance(value, Mapping):
+    if all(isinstance(k, str) for k in value):
+      return {k: _encode(v) for k, v in value.items()}
+    return {'__items__': [[_encode(k), _encode(v)] for k, v in value.items()]}
+  if isinstance(value, np.ndarray):
+    return {'__ndarray__': value.tolist(), 'dtype': value.dtype.str}
+  if isinstance(value, tuple):
+    return {'__tuple__': [_encode(v) for v in value]}
+  if isinstance(value, list):
+    return [_encode(v) for v in value]
+  if isinstance(value, np.generic):
+    return value.item()
+  return value
+
+
+def _decode(value):
+  """Inverse of _encode()."""
+  if isinstance(value, dict):
+    if '__items__' in value:
+      return {_decode(k): _decode(v) for k, v in value['__items__']}
+    if '__tuple__' in value:
+      return tuple(_decode(v) for v in value['__tuple__'])
+    if '__ndarray__' in value:
+      return np.array(value['__ndarray__'], dtype=value['dtype'])
+    return {k: _decode(v) for k, v in value.items()}
+  if isinstance(value, list):
+    return [_decode(v) for v in value]
+  return value
+
+
+def _flatten(tree, prefix=()):
+  if isinstance(tree, Mapping):
+    for k, v in tree.items():
+      yield from _flatten(v, prefix + (k,))
+  else:
+    yield prefix, np.asarray(tree)
+
+
+def convert(checkpoint_path: str, output_dir: str) -> None:
+  """Converts a pickled checkpoint into a checkpoint directory."""
+  with open(checkpoint_path, 'rb') as f:
+    checkpoint = pickle.load(f)
+
+  os.makedirs(output_dir, exist_ok=True)
+  # An existing manifest describes the old parameters; until the new one is
+  # written, the directory is incomplete.
+  manifest_path = os.path.join(output_dir, MANIFEST)
+  if os.path.exists(manifest_path):
+    os.remove(manifest_path)
+  arrays = []
+  offset = 0
+  with open(os.path.join(output_dir, PARAMS), 'wb') as f:
+    for key_path, array in _flatten(checkpoint['params']):
+      array = np.ascontiguousarray(
+          array, dtype=array.dtype.newbyteorder('<'))
+      offset = -(-offset // ALIGNMENT) * ALIGNMENT
+      f.seek(offset)
+      f.write(array.tobytes())
+      arrays.append({
+          'path': list(key_path),
+          'dtype': array.dtype.str,
+          'shape': list(array.shape),
+          'offset': offset,
+      })
+      offset += array.nbytes
+
+  manifest = {
+      'format_version': FORMAT_VERSION,
+      'model_config': _encode(checkpoint['model_config']),
+      'region_map': _encode(checkpoint['region_map']),
+      'alphabet': {
+          'idx2word': _encode(checkpoint['alphabet']['idx2word']),
+          'word2idx': _encode(checkpoint['alphabet']['word2idx']),
+      },
+      'params': arrays,
+  }
+  # Written last, and renamed into place, so that a directory with a manifest
+  # is complete.
+  with open(manifest_path + '.tmp', 'w', encoding='utf8') as f:
+    json.dump(manifest, f, ensure_ascii=False)
+  os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def load(path: str) -> Dict[str, Any]:
+  """Loads a checkpoint directory.
+
+  Args:
+    path: checkpoint directory.
+
+  Returns:
+    a dict with the same keys as a pickled checkpoint, whose `params` are
+    read-only NumPy views of the memory-mapped parameter file.
+  """
+  with open(os.path.join(path, MANIFEST), encoding='utf8') as f:
+    manifest = json.load(f)
+  if manifest['format_version'] != FORMAT_VERSION:
+    raise ValueError(
+        f'Unsupported checkpoint format {manifest["format_version"]}.')
+
+  params = {}
+  with open(os.path.join(path, PARAMS), 'rb') as f:
+    # The mapping stays valid after the file is closed, and is released once
+    # the last array viewing it is garbage collected.
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  for entry in manifest['params']:
+    dtype = np.dtype(entry['dtype'])
+    count = int(np.prod(entry['shape']))
+    array = np.frombuffer(
+        buffer, dtype=dtype, count=count,
+        offset=entry['offset']).reshape(entry['shape'])
+    node = params
+    for k in entry['path'][:-1]:
+      node = node.setdefault(k, {})
+    node[entry['path'][-1]] = array
+
+  return {
+      'params': params,
+      'model_config': _decode(manifest['model_config']),
+      'region_map': _decode(manifest['region_map']),
+      'alphabet': _decode(manifest['alphabet']),
+  }
+
+
+def main(argv):
+  if len(argv) != 3:
+    raise app.UsageError(
+        'Usage: checkpoint_dir.py <checkpoint.pkl> <output_dir>')
+  convert(argv[1], argv[2])
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,175 @@
+# Copyright 2021 the Ithaca Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent on-disk cache of compiled XLA executables.
+
+Every process otherwise traces and compiles `Model.apply` for each input shape
+it meets: each batch bucket of the beam search, each number of characters to
+restore, and the saliency gradients. With the cache enabled, compiled
+executables are written to `cache_dir` and later processes load them instead
+of compiling. Entries are keyed by the fingerprint of the compiled
+computation, which covers the model config and parameter shapes, and by the
+JAX and jaxlib versions and the device, so stale entries are never used.
+
+`enable()` must be called before the first compilation in the process. The
+cache is populated ahead of time, e.g. when building a serving image, with:
+
+  python -m ithaca.eval.compile_cache checkpoint.pkl compile_cache
+
+followed by the `length_buckets` passed to attribute() and restore(), if any.
+"""
+
+import threading
+from typing import NamedTuple, Optional, Sequence
+
+from absl import app
+from absl import logging
+from ithaca.eval import inference
+from ithaca.eval import registry
+
+import jax
+
+# Numbers of characters to restore compiled by prepopulate(); each one is a
+# different shape for the beam search.
+MISSING_COUNTS = tuple(range(1, 11))
+
+_lock = threading.Lock()
+_listener_registered = False
+_requests = 0
+_hits = 0
+
+
+class CompileCacheStats(NamedTuple):
+  """Compilations that used the cache since enable() or the last reset."""
+
+  hits: int
+  misses: int
+
+  @property
+  def hit_rate(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.
+
+
+def _on_event(event: str, **kwargs):
+  del kwargs  # Unused.
+  global _requests, _hits
+  with _lock:
+    if event == '/jax/compilation_cache/compile_requests_use_cache':
+      _requests += 1
+    elif event == '/jax/compilation_cache/cache_hits':
+      _hits += 1
+
+
+def enable(cache_dir: str) -> bool:
+  """Stores compiled executables in `cache_dir` and reuses them.
+
+  Returns:
+    whether the installed JAX supports a persistent compilation cache.
+  """
+  global _listener_registered
+  try:
+    jax.config.update('jax_compilation_cache_dir', cache_dir)
+  except AttributeError:
+    logging.warning('This JAX version has no persistent compilation cache.')
+    return False
+  # Cache every executable; even small ones are slow to compile on CPU.
+  jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+  jax.config.update('jax_persistent_cache_min_entry_size_bytes', 0)
+  with _lock:
+    if not _listener_registered:
+      jax.monitoring.register_event_listener(_on_event)
+      _listener_registered = True
+  reset_stats()
+  return True
+
+
+def stats() -> CompileCacheStats:
+  with _lock:
+    return CompileCacheStats(hits=_hits, misses=_requests - _hits)
+
+
+def reset_stats() -> None:
+  global _requests, _hits
+  with _lock:
+    _requests = 0
+    _hits = 0
+
+
+def _synthetic_text(length: int, missing: int = 0) -> str:
+  """Returns a text of `length` characters with `missing` '?' in the middle."""
+  words = 'αβγδε ζηθικ λμνξο πρστυ φχψω '
+  text = list((words * (length // len(words) + 1))[:length - 1] + 'α')
+  start = length // 2 - missing
+  for i in range(missing):
+    text[start + 2 * i] = inference.ALPHABET_MISSING_RESTORE
+  return ''.join(text)
+
+
+def prepopulate(model,
+                length_buckets: Optional[Sequence[int]] = None,
+                missing_counts: Sequence[int] = MISSING_COUNTS) -> None:
+  """Compiles the signatures used by attribute() and restore() for `model`.
+
+  Runs attribution (of one text and of a full batch) and restoration (of
+  each of `missing_counts` characters) on synthetic texts padded to each
+  sequence length, so that all their executables end up in the cache.
+
+  Args:
+    model: a `registry.LoadedModel`.
+    length_buckets: sequence lengths to compile for, see
+      `inference.LENGTH_BUCKETS`. Only the fixed model length by default.
+    missing_counts: numbers of characters to restore to compile for.
+  """
+  kwargs = dict(
+      forward=model.forward,
+      params=model.params,
+      alphabet=model.alphabet,
+      vocab_char_size=model.vocab_char_size,
+      vocab_word_size=model.vocab_word_size)
+  seq_lens = sorted(set(length_buckets or ()) | {inference.TEXT_LEN})
+  for seq_len in seq_lens:
+    # The text and its start of sentence symbol leave one padding character.
+    text = _synthetic_text(seq_len - 2)
+    inference.attribute(
+        text,
+        region_map=model.region_map,
+        length_buckets=length_buckets,
+        **kwargs)
+    inference.attribute_batch(
+        [text] * inference.ATTRIBUTION_BATCH_SIZE,
+        region_map=model.region_map,
+        length_buckets=length_buckets,
+        **kwargs)
+    for missing in missing_counts:
+      inference.restore(
+          _synthetic_text(seq_len - 2, missing),
+          length_buckets=length_buckets,
+          **kwargs)
+    logging.info('Compiled sequence length %d: %s.', seq_len, stats())
+
+
+def main(argv):
+  if len(argv) < 3:
+    raise app.UsageError(
+        'Usage: compile_cache.py <checkpoint> <cache_dir> [<seq_len> ...]')
+  if not enable(argv[2]):
+    raise app.UsageError('The persistent compilation cache is unsupported.')
+  prepopulate(
+      registry.get(argv[1]),
+      length_buckets=[int(seq_len) for seq_len in argv[3:]])
+  logging.info('Compile cache %s populated: %s.', argv[2], stats())
+
+
+if __name__ == '__main__':
+  app.run(main)
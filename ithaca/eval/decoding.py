@@ -0,0 +1,279 @@
+# Copyright 2021 the Ithaca Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Restoration beam search that runs entirely on the device.
+
+`eval_util.beam_search_batch_2d` copies the mask logits of every hypothesis
+back to the host on every step. `beam_search_on_device` performs the same
+search inside a single compiled `lax.fori_loop`: the beam's character and word
+indices, scores, remaining-mask bitmap, duplicate merging and top-k selection
+all stay on the device, and only the final hypotheses are transferred back.
+
+Word indices of the hypotheses are recomputed on the device from a hashed copy
+of the alphabet's word list, reproducing `util_text.text_to_word_idx`.
+"""
+
+import re
+import threading
+import weakref
+from typing import List
+
+from ithaca.eval import batching
+from ithaca.eval import engine as engine_lib
+from ithaca.models.model import Model
+from ithaca.util.eval import BeamEntry
+from ithaca.util.text import idx_to_text_batch
+from ithaca.util.text import text_to_idx
+
+import jax
+from jax import lax
+import jax.numpy as jnp
+import numpy as np
+
+# Odd multipliers (hence invertible modulo 2**32) of the two polynomial hashes
+# used for words and for restored characters.
+_HASH_MULTIPLIERS = (0x01000193, 0x5bd1e995)
+# Number of consecutive sorted vocabulary entries checked for a hash match.
+_HASH_PROBES = 4
+
+
+class _WordTable:
+  """Device-side lookup of word indices by polynomial hash."""
+
+  def __init__(self, alphabet):
+    is_word = np.array([bool(re.match(r'\w', c)) for c in alphabet.idx2char])
+    hashes = [[], []]
+    word_ids = []
+    for word, idx in alphabet.word2idx.items():
+      # Words that cannot be spelled in the alphabet are never looked up.
+      if not word or any(
+          c not in alphabet.char2idx or not is_word[alphabet.char2idx[c]]
+          for c in word):
+        continue
+      for h, multiplier in zip(hashes, _HASH_MULTIPLIERS):
+        value = 0
+        for i, c in enumerate(word):
+          value += alphabet.char2idx[c] * pow(multiplier, i, 2**32)
+        h.append(value % 2**32)
+      word_ids.append(idx)
+    order = np.lexsort((hashes[1], hashes[0]))
+    self.is_word = is_word
+    self.hash1 = np.array(hashes[0], dtype=np.uint32)[order]
+    self.hash2 = np.array(hashes[1], dtype=np.uint32)[order]
+    self.word_ids = np.array(word_ids, dtype=np.int32)[order]
+    self.unk_idx = alphabet.word2idx[alphabet.unk]
+    self.word2idx = alphabet.word2idx
+
+
+_word_tables = weakref.WeakKeyDictionary()
+_word_tables_lock = threading.Lock()
+
+
+def _get_word_table(alphabet) -> _WordTable:
+  with _word_tables_lock:
+    table = _word_tables.get(alphabet)
+    # The word list is usually replaced after construction, e.g. by the one
+    # stored in a checkpoint.
+    if table is None or table.word2idx is not alphabet.word2idx:
+      table = _WordTable(alphabet)
+      _word_tables[alphabet] = table
+  return table
+
+
+def _powers(multiplier, n):
+  """Returns multiplier**i and multiplier**-i modulo 2**32 for i < n."""
+  inverse = pow(multiplier, -1, 2**32)
+  return (np.array([pow(multiplier, i, 2**32) for i in range(n)],
+                   dtype=np.uint32),
+          np.array([pow(inverse, i, 2**32) for i in range(n)],
+                   dtype=np.uint32))
+
+
+def _word_idx(text_char, tables, powers):
+  """Device equivalent of `text_to_word_idx` for one row of char indices."""
+  is_word_table, hash1, hash2, word_ids, unk_idx = tables
+  length = text_char.shape[0]
+  pos = jnp.arange(length)
+  is_word = is_word_table[text_char]
+  prev_word = jnp.concatenate([jnp.zeros((1,), bool), is_word[:-1]])
+  next_word = jnp.concatenate([is_word[1:], jnp.zeros((1,), bool)])
+  start = lax.cummax(jnp.where(is_word & ~prev_word, pos, 0), axis=0)
+  end = lax.cummin(
+      jnp.where(is_word & ~next_word, pos, length - 1), axis=0, reverse=True)
+
+  queries = []
+  for pow_pos, pow_inv in powers:
+    pow_inv = jnp.asarray(pow_inv)
+    prefix = jnp.cumsum(
+        text_char.astype(jnp.uint32) * pow_pos, dtype=jnp.uint32)
+    prefix = jnp.concatenate([jnp.zeros((1,), jnp.uint32), prefix])
+    queries.append((prefix[end + 1] - prefix[start]) * pow_inv[start])
+
+  first = jnp.searchsorted(hash1, queries[0])
+  probes = jnp.minimum(first[:, None] + jnp.arange(_HASH_PROBES),
+                       hash1.shape[0] - 1)
+  match = (hash1[probes] == queries[0][:, None]) & (
+      hash2[probes] == queries[1][:, None])
+  found = word_ids[jnp.take_along_axis(
+      probes, jnp.argmax(match, axis=1)[:, None], axis=1)[:, 0]]
+  return jnp.where(is_word & match.any(axis=1), found, unk_idx)
+
+
+def _search(apply_fn, beam_width, temperature, params, text_char, mask_pos,
+            valid_chars, tables, rng):
+  """Compiled beam search; returns final chars, log-probabilities and mask."""
+  length = text_char.shape[0]
+  num_missing = mask_pos.shape[0]
+  num_chars = valid_chars.shape[0]
+  word_powers = [_powers(m, length) for m in _HASH_MULTIPLIERS]
+  key_powers = [_powers(m, num_missing)[0] for m in _HASH_MULTIPLIERS]
+  word_idx = jax.vmap(lambda chars: _word_idx(chars, tables, word_powers))
+
+  def mask_logprob(chars):
+    _, _, mask_logits, _ = apply_fn(
+        params,
+        text_char=chars,
+        text_word=word_idx(chars),
+        mask_positions=jnp.broadcast_to(mask_pos,
+                                        (chars.shape[0], num_missing)),
+        outputs=('mask',),
+        rngs={'dropout': rng},
+        is_training=False)
+    mask_logits = mask_logits / temperature
+    return jax.nn.log_softmax(mask_logits)[:, :, valid_chars]
+
+  def select(chars, remaining, logprob, alive, char_logprob):
+    """Expands every hypothesis and keeps the `beam_width` best."""
+    cand_logprob = logprob[:, None, None] + char_logprob
+    cand_alive = alive[:, None, None] & remaining[:, :, None]
+    cand_alive = jnp.broadcast_to(cand_alive, cand_logprob.shape).reshape(-1)
+    cand_logprob = cand_logprob.reshape(-1)
+
+    # Hash the restored characters of each candidate to merge duplicates.
+    restored = chars[:, mask_pos].astype(jnp.uint32)
+    keys = []
+    for pow_key in key_powers:
+      base = jnp.sum(restored * pow_key, axis=1, dtype=jnp.uint32)
+      key = (base[:, None, None] +
+             (valid_chars.astype(jnp.uint32)[None, None, :] -
+              restored[:, :, None]) * pow_key[None, :, None])
+      keys.append(key.reshape(-1))
+
+    # Among duplicates keep the lowest scoring live candidate, as the host
+    # beam search does.
+    index = jnp.arange(cand_logprob.shape[0])
+    key1, key2, dead, _, index = lax.sort(
+        (keys[0], keys[1], ~cand_alive, cand_logprob, index), num_keys=4)
+    first = jnp.concatenate([
+        jnp.ones((1,), bool), (key1[1:] != key1[:-1]) | (key2[1:] != key2[:-1])
+    ])
+    keep = jnp.zeros_like(cand_alive).at[index].set(first & ~dead)
+    cand_logprob = jnp.where(keep, cand_logprob, -jnp.inf)
+
+    logprob, best = lax.top_k(cand_logprob, beam_width)
+    beam_i = best // (num_missing * num_chars)
+    missing_i = (best // num_chars) % num_missing
+    char_i = best % num_chars
+    rows = jnp.arange(beam_width)
+    chars = chars[beam_i].at[rows, mask_pos[missing_i]].set(valid_chars[char_i])
+    remaining = remaining[beam_i].at[rows, missing_i].set(False)
+    return chars, remaining, logprob, jnp.isfinite(logprob)
+
+  # The first step expands the single input hypothesis.
+  chars = text_char[None]
+  remaining = jnp.ones((1, num_missing), bool)
+  logprob = jnp.zeros((1,), jnp.float32)
+  alive = jnp.ones((1,), bool)
+  state = select(chars, remaining, logprob, alive, mask_logprob(chars))
+
+  def body(_, state):
+    return select(*state, mask_logprob(state[0]))
+
+  chars, _, logprob, alive = lax.fori_loop(1, num_missing, body, state)
+  return chars, logprob, alive
+
+
+_compiled_lock = threading.Lock()
+_compiled = {}
+
+
+def _compiled_search(model_config, beam_width, temperature):
+  key = (beam_width, temperature, engine_lib.config_key(model_config))
+  with _compiled_lock:
+    fn = _compiled.get(key)
+    if fn is None:
+      apply_fn = Model(**model_config).apply
+      fn = jax.jit(lambda *args: _search(apply_fn, beam_width, temperature,
+                                         *args))
+      _compiled[key] = fn
+  return fn
+
+
+def beam_search_on_device(forward,
+                          alphabet,
+                          text_pred,
+                          mask_idx,
+                          rng=None,
+                          beam_width=20,
+                          temperature=1.) -> List[BeamEntry]:
+  """Non-sequential beam search compiled into a single device loop.
+
+  Produces the same hypotheses as `eval_util.beam_search_batch_2d` without
+  nucleus sampling.
+
+  Args:
+    forward: an `engine.InferenceEngine` (or a `batching.BatchingForward` of
+      one); its model config and params are used to build the compiled search.
+    alphabet: GreekAlphabet object containing index/character mappings.
+    text_pred: padded input text, with missing characters to be restored.
+    mask_idx: positions of the characters to restore.
+    rng: JAX PRNGKey passed to the model.
+    beam_width: number of hypotheses kept at every step.
+    temperature: softmax temperature of the mask logits.
+
+  Returns:
+    Up to `beam_width` complete hypotheses, best first.
+  """
+  if isinstance(forward, batching.BatchingForward):
+    # The whole search is one device program, which cannot be batched.
+    forward = forward.forward
+  if not isinstance(forward, engine_lib.InferenceEngine):
+    raise ValueError('On-device decoding requires an InferenceEngine.')
+  mask_idx = list(mask_idx)
+  if not mask_idx:
+    return []
+  if rng is None:
+    rng = jax.random.PRNGKey(0)
+
+  table = _get_word_table(alphabet)
+  tables = (table.is_word, table.hash1, table.hash2, table.word_ids,
+            np.int32(table.unk_idx))
+  valid_chars = np.array(
+      [alphabet.char2idx[alphabet.space]] +
+      list(range(alphabet.alphabet_start_idx,
+                 alphabet.char2idx[alphabet.punctuation[-1]] + 1)),
+      dtype=np.int32)
+
+  search = _compiled_search(forward.model_config, beam_width, temperature)
+  chars, logprob, alive = search(forward.params,
+                                 text_to_idx(text_pred, alphabet),
+                                 np.array(mask_idx, dtype=np.int32),
+                                 valid_chars, tables, rng)
+  chars, logprob, alive = jax.device_get((chars, logprob, alive))
+
+  texts = idx_to_text_batch(chars, alphabet, strip_sos=False, strip_pad=False)
+  return [
+      BeamEntry(texts[i], [], len(mask_idx), float(logprob[i]))
+      for i in range(len(logprob))
+      if alive[i]
+  ]
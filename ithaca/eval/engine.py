@@ -0,0 +1,124 @@
+# Copyright 2021 the Ithaca Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compiled, batch-bucketed forward function for inference.
+
+`InferenceEngine` is a drop-in replacement for the `forward` function expected
+by attribute(), restore() and the eval utils, i.e.
+`functools.partial(model.apply, params)`. Calls are compiled with `jax.jit`,
+and the batch dimension of every input is padded up to one of a small set of
+bucket sizes, so that the varying batch sizes produced by beam search reuse a
+handful of executables instead of triggering a new trace for each size. Each
+sequence length (see `inference.LENGTH_BUCKETS`) is compiled separately by
+`jax.jit`, which keys its executables on input shapes.
+"""
+
+import threading
+from typing import Any, Dict, Sequence, Tuple
+
+from ithaca.models.model import Model
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+# Batch sizes that inputs are padded up to. Larger batches are padded to a
+# multiple of the last bucket.
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32)
+
+# Keyword arguments of Model.__call__ that are not batched model inputs.
+_STATIC_ARGNAMES = ('is_training', 'outputs')
+_UNBATCHED_ARGNAMES = ('rngs',) + _STATIC_ARGNAMES
+
+# Compiled apply functions shared by all engines in the process, keyed by
+# (batch bucket, model config).
+_compiled_lock = threading.Lock()
+_compiled = {}
+
+
+def batch_bucket(batch_size: int,
+                 buckets: Sequence[int] = BATCH_BUCKETS) -> int:
+  """Returns the smallest bucket that fits `batch_size`."""
+  for bucket in buckets:
+    if batch_size <= bucket:
+      return bucket
+  return -(-batch_size // buckets[-1]) * buckets[-1]
+
+
+def config_key(model_config: Dict[str, Any]) -> Tuple[Tuple[str, Any], ...]:
+  return tuple(sorted(model_config.items()))
+
+
+def compiled_apply(model_config: Dict[str, Any], bucket: int):
+  """Returns the jitted `Model.apply` for the given config and batch bucket."""
+  key = (bucket, config_key(model_config))
+  with _compiled_lock:
+    fn = _compiled.get(key)
+    if fn is None:
+      model = Model(**model_config)
+      fn = jax.jit(model.apply, static_argnames=_STATIC_ARGNAMES)
+      _compiled[key] = fn
+  return fn
+
+
+def _pad_batch(x, bucket):
+  """Pads the leading axis to `bucket` by repeating the last row."""
+  pad = bucket - x.shape[0]
+  if pad == 0:
+    return x
+  pad_width = [(0, pad)] + [(0, 0)] * (x.ndim - 1)
+  if isinstance(x, np.ndarray):
+    return np.pad(x, pad_width, mode='edge')
+  # Traced values, e.g. embeddings being differentiated for saliency maps.
+  return jnp.pad(x, pad_width, mode='edge')
+
+
+class InferenceEngine:
+  """Callable with the signature of `functools.partial(model.apply, params)`.
+
+  Attributes:
+    model_config: arguments to the model's constructor.
+    params: model parameters.
+    buckets: batch sizes that inputs are padded up to.
+  """
+
+  def __init__(self,
+               model_config: Dict[str, Any],
+               params: Any,
+               buckets: Sequence[int] = BATCH_BUCKETS):
+    self.model_config = dict(model_config)
+    self.params = params
+    self.buckets = tuple(sorted(buckets))
+
+  def __call__(self, *, is_training=False, outputs=None, **kwargs):
+    if outputs is not None:
+      # Static arguments must be hashable; any order selects the same heads.
+      outputs = tuple(sorted(set(outputs)))
+    batch_size = None
+    for name, value in kwargs.items():
+      if name not in _UNBATCHED_ARGNAMES and value is not None:
+        batch_size = value.shape[0]
+        break
+    if batch_size is None:
+      raise ValueError('Wrong inputs.')
+
+    bucket = batch_bucket(batch_size, self.buckets)
+    inputs = {
+        name: (value if name in _UNBATCHED_ARGNAMES or value is None else
+               _pad_batch(value, bucket)) for name, value in kwargs.items()
+    }
+    results = compiled_apply(self.model_config, bucket)(
+        self.params, is_training=is_training, outputs=outputs, **inputs)
+    if bucket == batch_size:
+      return results
+    return jax.tree_util.tree_map(lambda x: x[:batch_size], results)
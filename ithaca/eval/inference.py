@@ -14,21 +14,31 @@
 """Module for performing inference using Jax, including decoding.
 
 The module is separated into two main entrypoints: attribute() and restore().
+attribute_batch() is the batched variant of attribute() for bulk processing,
+and attribute_packed() an approximate variant that packs several short texts
+into each model row.
 
 Both take a function called `forward`, a Jax function mapping from model inputs
 (excluding parameters) to the model output tuple. Generated using
-e.g. `functools.partial(exp.forward.apply, exp._params)`.
+e.g. `functools.partial(exp.forward.apply, exp._params)`, or, for compiled
+execution, `engine.InferenceEngine(model_config, params)`.
 """
 
+import functools
+import itertools
 import json
 import math
 import re
-from typing import List, NamedTuple, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
+from ithaca.eval import decoding
+from ithaca.eval import forward_memo
 import ithaca.util.eval as eval_util
 import ithaca.util.text as util_text
 
+from absl import logging
 import jax
+import jax.numpy as jnp
 import numpy as np
 
 
@@ -137,26 +147,69 @@ RESTORATION_BEAM_WIDTH = 20
 RESTORATION_TEMPERATURE = 1.
 SEED = 1
 ALPHABET_MISSING_RESTORE = '?'  # missing characters to restore
+ATTRIBUTION_BATCH_SIZE = 8  # texts per model call in attribute_batch()
+
+# Block-aligned sequence lengths that short texts may be padded to instead of
+# TEXT_LEN. BigBird's random attention needs at least 8 blocks of 64 after its
+# own padding block, hence 448. Results differ slightly from those at TEXT_LEN,
+# as the random attention connectivity depends on the length; see
+# length_bucket_divergence().
+LENGTH_BUCKETS = (448, 512, 640, TEXT_LEN)
+
+# Suggested `fill_threshold` for restore(): characters predicted with at least
+# this probability are restored in parallel rather than one per step. Results
+# are approximate; see parallel_fill_divergence().
+RESTORATION_FILL_THRESHOLD = 0.9
+
+
+# Number of texts whose prepared model inputs are kept, e.g. so that
+# attribute() and restore() of the same text prepare it once.
+PREPARED_TEXT_CACHE_SIZE = 256
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def seq_len_for(text_len, length_buckets=None) -> int:
+  """Returns the padded length for a text of `text_len` (including SOS)."""
+  if length_buckets:
+    for seq_len in sorted(length_buckets):
+      # Keep at least one padding character, as at TEXT_LEN.
+      if text_len < seq_len <= TEXT_LEN:
+        return seq_len
+  return TEXT_LEN
 
 
 def _prepare_text(
-    text, alphabet
+    text, alphabet, length_buckets=None
 ) -> Tuple[str, str, str, np.ndarray, np.ndarray, List[int], np.ndarray,
            List[int]]:
   """Adds start of sequence symbol, and padding.
 
   Also strips accents if present, trims whitespace, and generates arrays ready
-  for input into the model.
+  for input into the model. Results are memoized, so the returned arrays are
+  shared between calls and read-only.
 
   Args:
     text: Raw text input string, no padding or start of sequence symbol.
     alphabet: GreekAlphabet object containing index/character mappings.
+    length_buckets: optional sequence lengths to pad to instead of TEXT_LEN.
 
   Returns:
     Tuple of cleaned text (str), padded text (str), char indices (array of batch
     size 1), word indices (array of batch size 1), text length (list of size 1)
   """
-  text = re.sub(r'\s+', ' ', text.strip())
+  (text, text_sos, text_padded, text_char, text_word, text_len, padding,
+   restore_mask_idx) = _prepare_text_cached(
+       text, alphabet,
+       tuple(sorted(set(length_buckets))) if length_buckets else None)
+  return (text, text_sos, text_padded, text_char, text_word, list(text_len),
+          padding, list(restore_mask_idx))
+
+
+@functools.lru_cache(maxsize=PREPARED_TEXT_CACHE_SIZE)
+def _prepare_text_cached(text, alphabet, length_buckets):
+  """_prepare_text() with hashable arguments and immutable results."""
+  text = _WHITESPACE.sub(' ', text.strip())
   text = util_text.strip_accents(text)
 
   if len(text) < MIN_TEXT_LEN:
@@ -168,7 +221,8 @@ def _prepare_text(
   text_sos = alphabet.sos + text
   text_len = [len(text_sos)]  # includes SOS, but not padding
 
-  text_padded = text_sos + alphabet.pad * max(0, TEXT_LEN - len(text_sos))
+  seq_len = seq_len_for(len(text_sos), length_buckets)
+  text_padded = text_sos + alphabet.pad * max(0, seq_len - len(text_sos))
 
   restore_mask_idx = [
       i for i, c in enumerate(text_padded) if c == ALPHABET_MISSING_RESTORE
@@ -178,28 +232,19 @@ def _prepare_text(
   text_char = util_text.text_to_idx(text_padded, alphabet).reshape(1, -1)
   text_word = util_text.text_to_word_idx(text_padded, alphabet).reshape(1, -1)
   padding = np.where(text_char > 0, 1, 0)
+  for array in (text_char, text_word, padding):
+    array.flags.writeable = False
 
-  return (text, text_sos, text_padded, text_char, text_word, text_len, padding,
-          restore_mask_idx)
-
+  return (text, text_sos, text_padded, text_char, text_word, tuple(text_len),
+          padding, tuple(restore_mask_idx))
 
-def attribute(text, forward, params, alphabet, vocab_char_size, vocab_word_size,
-              region_map) -> AttributionResults:
-  """Computes predicted date and geographical region."""
 
-  (text, _, _, text_char, text_word, text_len, padding,
-   _) = _prepare_text(text, alphabet)
-
-  rng = jax.random.PRNGKey(SEED)
-  date_logits, subregion_logits, _, _ = forward(
-      text_char=text_char,
-      text_word=text_word,
-      rngs={'dropout': rng},
-      is_training=False)
+def _attribution_results(text, date_logits, subregion_logits, date_saliency,
+                         subregion_saliency, region_map) -> AttributionResults:
+  """Builds the attribution results of one text from model outputs."""
 
   # Generate subregion predictions:
-  subregion_logits = np.array(subregion_logits)
-  subregion_pred_probs = eval_util.softmax(subregion_logits[0]).tolist()
+  subregion_pred_probs = eval_util.softmax(subregion_logits).tolist()
   location_predictions = [
       LocationPrediction(location_id=id, score=prob)
       for prob, id in zip(subregion_pred_probs, region_map['sub']['ids'])
@@ -207,12 +252,7 @@ def attribute(text, forward, params, alphabet, vocab_char_size, vocab_word_size,
   location_predictions.sort(key=lambda loc: loc.score, reverse=True)
 
   # Generate date predictions:
-  date_pred_probs = eval_util.softmax(date_logits[0])
-
-  # Gradients for saliency maps
-  date_saliency, subregion_saliency = eval_util.compute_attribution_saliency_maps(
-      text_char, text_word, text_len, padding, forward, params, rng, alphabet,
-      vocab_char_size, vocab_word_size)
+  date_pred_probs = eval_util.softmax(date_logits)
 
   # Skip start of sequence symbol (first char) for text and saliency maps:
   return AttributionResults(
@@ -223,24 +263,334 @@ def attribute(text, forward, params, alphabet, vocab_char_size, vocab_word_size,
       location_saliency=subregion_saliency.tolist()[1:])
 
 
-def restore(text, forward, params, alphabet, vocab_char_size,
-            vocab_word_size) -> RestorationResults:
-  """Performs search to compute text restoration. Slower, runs synchronously."""
+def _attribution_cache_key(results_cache, text, length_buckets):
+  if length_buckets:
+    return results_cache.key(
+        'attribute', text, seed=SEED, length_buckets=sorted(length_buckets))
+  return results_cache.key('attribute', text, seed=SEED)
+
+
+def attribute(text,
+              forward,
+              params,
+              alphabet,
+              vocab_char_size,
+              vocab_word_size,
+              region_map,
+              cache=None,
+              length_buckets=None) -> AttributionResults:
+  """Computes predicted date and geographical region.
+
+  If a `cache.ResultCache` is given, results are looked up in and stored to it.
+  With `length_buckets` (e.g. LENGTH_BUCKETS), the text is padded to the
+  shortest bucket that fits rather than to TEXT_LEN.
+  """
+
+  (text, _, _, text_char, text_word, text_len, padding,
+   _) = _prepare_text(text, alphabet, length_buckets)
+
+  if cache is not None:
+    cache_key = _attribution_cache_key(cache, text, length_buckets)
+    results = cache.get(cache_key)
+    if results is not None:
+      return results
+
+  # Logits and gradients for saliency maps, from a single forward pass
+  rng = jax.random.PRNGKey(SEED)
+  (date_logits, subregion_logits, date_saliency,
+   subregion_saliency) = eval_util.compute_attribution_logits_and_saliency_maps(
+       text_char, text_word, text_len, padding, forward, params, rng, alphabet,
+       vocab_char_size, vocab_word_size)
+
+  results = _attribution_results(text, date_logits[0], subregion_logits[0],
+                                 date_saliency[0], subregion_saliency[0],
+                                 region_map)
+  if cache is not None:
+    cache.put(cache_key, results)
+  return results
+
+
+def attribute_batch(texts,
+                    forward,
+                    params,
+                    alphabet,
+                    vocab_char_size,
+                    vocab_word_size,
+                    region_map,
+                    batch_size=ATTRIBUTION_BATCH_SIZE,
+                    cache=None,
+                    length_buckets=None) -> List[Optional[AttributionResults]]:
+  """Computes predicted date and geographical region for many texts.
+
+  Texts are prepared together and run through the model `batch_size` at a
+  time. A text that cannot be attributed (e.g. too short or too long, or with
+  a character outside the alphabet) does not fail the batch; its entry in the
+  returned list is None.
+
+  Args:
+    texts: raw text inputs, as for attribute().
+    forward: model forward function, as for attribute().
+    params: model parameters.
+    alphabet: GreekAlphabet object containing index/character mappings.
+    vocab_char_size: size of the character vocabulary.
+    vocab_word_size: size of the word vocabulary.
+    region_map: dict of dicts containing region mapping information.
+    batch_size: number of texts per model call.
+    cache: optional `cache.ResultCache`; cached texts are not run again.
+    length_buckets: optional sequence lengths to pad to instead of TEXT_LEN;
+      texts are batched with others of the same padded length.
+
+  Returns:
+    One AttributionResults (or None) per input text, in input order.
+  """
+
+  results = [None] * len(texts)
+  prepared = []
+  for i, text in enumerate(texts):
+    try:
+      prepared_text = _prepare_text(text, alphabet, length_buckets)
+    except ValueError as e:
+      logging.warning('Skipping text %d: %s', i, e)
+      continue
+    except KeyError as e:
+      logging.warning('Skipping text %d: unknown character %s.', i, e)
+      continue
+    if cache is not None:
+      results[i] = cache.get(
+          _attribution_cache_key(cache, prepared_text[0], length_buckets))
+      if results[i] is not None:
+        continue
+    prepared.append((i, prepared_text))
+
+  # Only texts padded to the same length can share a batch.
+  def seq_len(prepared_text):
+    return prepared_text[1][3].shape[1]
+
+  batches = []
+  for _, group in itertools.groupby(
+      sorted(prepared, key=seq_len), key=seq_len):
+    group = list(group)
+    batches.extend(
+        group[start:start + batch_size]
+        for start in range(0, len(group), batch_size))
+
+  rng = jax.random.PRNGKey(SEED)
+  for batch in batches:
+    text_char = np.concatenate([p[3] for _, p in batch])
+    text_word = np.concatenate([p[4] for _, p in batch])
+    text_len = [p[5][0] for _, p in batch]
+    padding = np.concatenate([p[6] for _, p in batch])
+    (date_logits, subregion_logits, date_saliency, subregion_saliency
+    ) = eval_util.compute_attribution_logits_and_saliency_maps(
+        text_char, text_word, text_len, padding, forward, params, rng, alphabet,
+        vocab_char_size, vocab_word_size)
+
+    for j, (i, prepared_text) in enumerate(batch):
+      results[i] = _attribution_results(prepared_text[0], date_logits[j],
+                                        subregion_logits[j], date_saliency[j],
+                                        subregion_saliency[j], region_map)
+      if cache is not None:
+        cache.put(
+            _attribution_cache_key(cache, prepared_text[0], length_buckets),
+            results[i])
+  return results
+
+
+def _pack_rows(lengths, seq_len) -> List[List[int]]:
+  """Packs texts of the given lengths into rows, first fit decreasing."""
+  rows = []
+  space = []
+  for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+    for row, row_space in enumerate(space):
+      if lengths[i] <= row_space:
+        break
+    else:
+      row = len(rows)
+      rows.append([])
+      space.append(seq_len)
+    rows[row].append(i)
+    space[row] -= lengths[i]
+  return rows
+
+
+def attribute_packed(texts,
+                     forward,
+                     params,
+                     alphabet,
+                     vocab_char_size,
+                     vocab_word_size,
+                     region_map,
+                     batch_size=ATTRIBUTION_BATCH_SIZE
+                    ) -> List[Optional[AttributionResults]]:
+  """Approximate attribute_batch() for short texts, packed several per row.
+
+  Each text keeps its SOS symbol and positions, and only attends to itself,
+  but its tokens fall in different BigBird blocks than when it starts a row of
+  its own. Date and location scores are therefore close to, not identical to,
+  those of attribute(), while the saliency maps can differ substantially; use
+  attribute_batch() where the saliency maps matter.
+
+  Args:
+    texts: raw text inputs, as for attribute().
+    forward: model forward function, as for attribute().
+    params: model parameters.
+    alphabet: GreekAlphabet object containing index/character mappings.
+    vocab_char_size: size of the character vocabulary.
+    vocab_word_size: size of the word vocabulary.
+    region_map: dict of dicts containing region mapping information.
+    batch_size: number of packed rows per model call.
+
+  Returns:
+    One AttributionResults (or None) per input text, in input order.
+  """
+  del vocab_char_size, vocab_word_size  # Unused, embeddings are gathered.
+
+  prepared = []
+  for i, text in enumerate(texts):
+    try:
+      prepared.append((i, _prepare_text(text, alphabet)))
+    except ValueError as e:
+      logging.warning('Skipping text %d: %s', i, e)
+    except KeyError as e:
+      logging.warning('Skipping text %d: unknown character %s.', i, e)
+
+  lengths = [p[5][0] for _, p in prepared]
+  rows = _pack_rows(lengths, TEXT_LEN)
+  max_segments = TEXT_LEN // (MIN_TEXT_LEN + 1)
+
+  results = [None] * len(texts)
+  rng = jax.random.PRNGKey(SEED)
+  for start in range(0, len(rows), batch_size):
+    batch = rows[start:start + batch_size]
+    text_char = np.zeros((len(batch), TEXT_LEN), dtype=np.int32)
+    text_word = np.zeros((len(batch), TEXT_LEN), dtype=np.int32)
+    segmentation = np.zeros((len(batch), TEXT_LEN), dtype=np.int32)
+    positions = np.zeros((len(batch), TEXT_LEN), dtype=np.int32)
+    segment_starts = np.zeros((len(batch), max_segments), dtype=np.int32)
+    weights = np.zeros((len(batch), max_segments), dtype=np.float32)
+    spans = []  # (row, segment, prepared index, start, length)
+    for row, texts_in_row in enumerate(batch):
+      offset = 0
+      for segment, j in enumerate(texts_in_row):
+        length = lengths[j]
+        span = slice(offset, offset + length)
+        text_char[row, span] = prepared[j][1][3][0, :length]
+        text_word[row, span] = prepared[j][1][4][0, :length]
+        segmentation[row, span] = segment + 1
+        positions[row, span] = np.arange(length)
+        segment_starts[row, segment] = offset
+        weights[row, segment] = 1.
+        spans.append((row, segment, j, offset, length))
+        offset += length
+    padding = np.where(text_char > 0, 1, 0)
+
+    # Logits and gradients of all packed texts, from a single forward pass
+    text_char_emb, text_word_emb = eval_util.embed(params, text_char, text_word)
+    _, saliency_vjp, (date_logits, subregion_logits) = jax.vjp(
+        lambda char_emb, word_emb: eval_util.saliency_outputs_attribution(  # pylint: disable=g-long-lambda
+            forward,
+            char_emb,
+            word_emb,
+            padding,
+            rng,
+            weights=weights,
+            inputs_segmentation=segmentation,
+            inputs_positions=positions,
+            segment_starts=segment_starts),
+        text_char_emb,
+        text_word_emb,
+        has_aux=True)
+    gradient_char, gradient_word = jax.vmap(saliency_vjp)(
+        jnp.eye(2, dtype=date_logits.dtype))
+    input_grad_char = np.multiply(gradient_char, text_char_emb[None])
+    input_grad_word = np.multiply(gradient_word, text_word_emb[None])
+    date_logits = np.array(date_logits)
+    subregion_logits = np.array(subregion_logits)
+
+    for row, segment, j, offset, length in spans:
+      span = slice(offset, offset + length)
+      saliency = []
+      for output in (0, 1):
+        grad_char = eval_util.grad_to_saliency_char(
+            input_grad_char[output, row:row + 1, span],
+            text_char[row:row + 1, span], [length], alphabet)
+        grad_word = eval_util.grad_to_saliency_word(
+            input_grad_word[output, row:row + 1, span],
+            text_word[row:row + 1, span], [length], alphabet)
+        saliency.append(np.clip(grad_char + grad_word, 0, 1))
+      i, prepared_text = prepared[j]
+      results[i] = _attribution_results(prepared_text[0],
+                                        date_logits[row, segment],
+                                        subregion_logits[row, segment],
+                                        saliency[0], saliency[1], region_map)
+  return results
+
+
+def restore(text,
+            forward,
+            params,
+            alphabet,
+            vocab_char_size,
+            vocab_word_size,
+            on_device=False,
+            cache=None,
+            length_buckets=None,
+            fill_threshold=None) -> RestorationResults:
+  """Performs search to compute text restoration. Slower, runs synchronously.
+
+  With `on_device`, the beam search runs as a single compiled loop on the
+  device; `forward` must then be an `engine.InferenceEngine`. If a
+  `cache.ResultCache` is given, results are looked up in and stored to it.
+  With `length_buckets` (e.g. LENGTH_BUCKETS), the text is padded to the
+  shortest bucket that fits rather than to TEXT_LEN. With `fill_threshold`
+  (e.g. RESTORATION_FILL_THRESHOLD), all characters predicted with at least
+  that probability are restored in a single step, which needs fewer decoding
+  steps but only approximates the exact beam search.
+  """
+  del vocab_char_size, vocab_word_size  # Unused, embeddings are gathered.
 
   if ALPHABET_MISSING_RESTORE not in text:
     raise ValueError('At least one character must be missing.')
+  if on_device and fill_threshold is not None:
+    raise ValueError('fill_threshold is not supported on device.')
 
   text, _, text_padded, _, _, text_len, _, restore_mask_idx = _prepare_text(
-      text, alphabet)
-
-  beam_result = eval_util.beam_search_batch_2d(
-      forward,
-      alphabet,
-      text_padded,
-      restore_mask_idx,
+      text, alphabet, length_buckets)
+
+  if cache is not None:
+    cache_params = dict(
+        beam_width=RESTORATION_BEAM_WIDTH,
+        temperature=RESTORATION_TEMPERATURE,
+        seed=SEED,
+        on_device=on_device)
+    if length_buckets:
+      cache_params['length_buckets'] = sorted(length_buckets)
+    if fill_threshold is not None:
+      cache_params['fill_threshold'] = fill_threshold
+    cache_key = cache.key('restore', text, **cache_params)
+    results = cache.get(cache_key)
+    if results is not None:
+      return results
+
+  # The greedy restoration behind the saliency maps starts from the same text
+  # as the beam search, and mostly revisits the beam's hypotheses, so both
+  # share their forward passes for this request.
+  memo = forward_memo.ForwardMemo(forward)
+  beam_kwargs = dict(
       beam_width=RESTORATION_BEAM_WIDTH,
       temperature=RESTORATION_TEMPERATURE,
       rng=jax.random.PRNGKey(SEED))
+  if on_device:
+    beam_result = decoding.beam_search_on_device(
+        forward, alphabet, text_padded, restore_mask_idx, **beam_kwargs)
+  elif fill_threshold is not None:
+    beam_result, fill_stats = eval_util.beam_search_parallel_fill(
+        memo, alphabet, text_padded, restore_mask_idx, fill_threshold,
+        **beam_kwargs)
+    logging.debug('Parallel fill: %s.', fill_stats)
+  else:
+    beam_result = eval_util.beam_search_batch_2d(
+        memo, alphabet, text_padded, restore_mask_idx, **beam_kwargs)
 
   # For visualization purposes, we strip out the SOS and padding, and adjust
   # restored_indices accordingly
@@ -252,11 +602,16 @@ def restore(text, forward, params, alphabet, vocab_char_size,
   restored_indices = [i - 1 for i in restore_mask_idx]
 
   # Sequence of saliency maps for a greedy prediction:
-  saliency_steps = eval_util.sequential_restoration_saliency(
-      text_padded, text_len, forward, params, alphabet, restore_mask_idx,
-      vocab_char_size, vocab_word_size)
+  saliency_steps = eval_util.batched_restoration_saliency(
+      text_padded,
+      text_len,
+      memo,
+      params,
+      alphabet,
+      restore_mask_idx,
+      fill_threshold=fill_threshold)
 
-  return RestorationResults(
+  results = RestorationResults(
       input_text=text,
       top_prediction=predictions[0].text,
       restored=restored_indices,
@@ -266,3 +621,107 @@ def restore(text, forward, params, alphabet, vocab_char_size,
                                   step.saliency_map.tolist())
           for step in saliency_steps
       ])
+  if cache is not None:
+    cache.put(cache_key, results)
+  return results
+
+
+def length_bucket_divergence(text,
+                             forward,
+                             params,
+                             alphabet,
+                             vocab_char_size,
+                             vocab_word_size,
+                             region_map,
+                             length_buckets=LENGTH_BUCKETS) -> Dict[str, float]:
+  """Compares bucketed attribution of `text` against padding to TEXT_LEN.
+
+  Used to validate `length_buckets` for a checkpoint before enabling them.
+
+  Returns:
+    Maximum absolute differences of the date probabilities, the location
+    probabilities and the two saliency maps, and the bucket length used.
+  """
+  kwargs = dict(
+      forward=forward,
+      params=params,
+      alphabet=alphabet,
+      vocab_char_size=vocab_char_size,
+      vocab_word_size=vocab_word_size,
+      region_map=region_map)
+  full = attribute(text, **kwargs)
+  bucketed = attribute(text, length_buckets=length_buckets, **kwargs)
+
+  def max_diff(a, b):
+    return float(np.max(np.abs(np.array(a) - np.array(b)))) if a else 0.
+
+  def location_scores(results):
+    return [l.score for l in sorted(results.locations)]
+
+  return {
+      'seq_len':
+          seq_len_for(len(full.input_text) + 1, length_buckets),
+      'year_scores':
+          max_diff(full.year_scores, bucketed.year_scores),
+      'location_scores':
+          max_diff(location_scores(full), location_scores(bucketed)),
+      'date_saliency':
+          max_diff(full.date_saliency, bucketed.date_saliency),
+      'location_saliency':
+          max_diff(full.location_saliency, bucketed.location_saliency),
+  }
+
+
+def parallel_fill_divergence(
+    text,
+    forward,
+    params,
+    alphabet,
+    vocab_char_size,
+    vocab_word_size,
+    fill_threshold=RESTORATION_FILL_THRESHOLD) -> Dict[str, float]:
+  """Compares restoration of `text` with parallel filling against the exact one.
+
+  Used to choose `fill_threshold` for a checkpoint before enabling it.
+
+  Returns:
+    The decoding steps of both searches and the steps saved, the number of
+    characters filled in parallel, whether the top predictions agree, the
+    overlap of the two sets of predictions and the absolute difference of the
+    top prediction scores.
+  """
+  del params, vocab_char_size, vocab_word_size  # Unused, restoration only.
+  if ALPHABET_MISSING_RESTORE not in text:
+    raise ValueError('At least one character must be missing.')
+  _, _, text_padded, _, _, _, _, restore_mask_idx = _prepare_text(
+      text, alphabet)
+
+  kwargs = dict(
+      beam_width=RESTORATION_BEAM_WIDTH,
+      temperature=RESTORATION_TEMPERATURE,
+      rng=jax.random.PRNGKey(SEED))
+  memo = forward_memo.ForwardMemo(forward)
+  exact = eval_util.beam_search_batch_2d(memo, alphabet, text_padded,
+                                         restore_mask_idx, **kwargs)
+  parallel, stats = eval_util.beam_search_parallel_fill(
+      memo, alphabet, text_padded, restore_mask_idx, fill_threshold, **kwargs)
+
+  exact_texts = {b.text_pred for b in exact}
+  parallel_texts = {b.text_pred for b in parallel}
+  return {
+      'exact_steps':
+          stats.num_missing,
+      'parallel_steps':
+          stats.steps,
+      'steps_saved':
+          stats.steps_saved,
+      'parallel':
+          stats.parallel,
+      'top_prediction_match':
+          float(exact[0].text_pred == parallel[0].text_pred),
+      'prediction_overlap':
+          len(exact_texts & parallel_texts) / len(parallel_texts),
+      'top_score':
+          abs(math.exp(exact[0].pred_logprob) -
+              math.exp(parallel[0].pred_logprob)),
+  }
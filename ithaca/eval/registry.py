@@ -0,0 +1,215 @@
+# Copyright 2021 the Ithaca Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Process-wide registry of loaded model checkpoints.
+
+Loading a checkpoint reads the full parameter tree and places it on the
+device, which is far too slow to do per request. The registry loads every
+checkpoint at most once per process and hands out the same `LoadedModel` to
+all callers, so concurrent requests share one copy of the parameters.
+
+Typical use:
+
+  registry.register('ithaca', 'checkpoint.pkl')
+  registry.warmup()
+  model = registry.get('ithaca')
+  inference.attribute(text, forward=model.forward, params=model.params, ...)
+"""
+
+import os
+import pickle
+import threading
+from typing import Any, Callable, Dict, NamedTuple, Optional, Sequence
+
+from ithaca.eval import checkpoint_dir
+from ithaca.eval import engine
+from ithaca.eval import inference
+from ithaca.util.alphabet import GreekAlphabet
+
+import jax
+import numpy as np
+
+
+class LoadedModel(NamedTuple):
+  """Everything needed to call attribute() and restore() for one checkpoint."""
+
+  name: str
+  path: str
+  model_config: Dict[str, Any]
+  region_map: Dict[str, Any]
+  alphabet: GreekAlphabet
+  params: Any
+  forward: Callable[..., Any]
+
+  @property
+  def vocab_char_size(self) -> int:
+    return self.model_config['vocab_char_size']
+
+  @property
+  def vocab_word_size(self) -> int:
+    return self.model_config['vocab_word_size']
+
+
+def load_checkpoint(path):
+  """Loads a checkpoint pickle or checkpoint directory.
+
+  Args:
+    path: path to checkpoint pickle, or to a directory written by
+      `checkpoint_dir.convert()`, whose parameters are memory-mapped.
+
+  Returns:
+    a model config dictionary (arguments to the model's constructor), a dict of
+    dicts containing region mapping information, a GreekAlphabet instance with
+    indices and words populated from the checkpoint, a dict of Jax arrays
+    `params`, and a `forward` function.
+  """
+
+  # Checkpoint dict containing params and various config:
+  if checkpoint_dir.is_checkpoint_dir(path):
+    checkpoint = checkpoint_dir.load(path)
+  else:
+    with open(path, 'rb') as f:
+      checkpoint = pickle.load(f)
+
+  # We reconstruct the model using the same arguments as during training, which
+  # are saved as a dict in the "model_config" key, and construct a `forward`
+  # function of the form required by attribute() and restore(). The engine
+  # compiles the model and pads batches to a few fixed sizes.
+  params = jax.device_put(checkpoint['params'])
+  forward = engine.InferenceEngine(checkpoint['model_config'], params)
+
+  # Contains the mapping between region IDs and names:
+  region_map = checkpoint['region_map']
+
+  # Use vocabulary mapping from the checkpoint, the rest of the values in the
+  # class are fixed and constant e.g. the padding symbol
+  alphabet = GreekAlphabet()
+  alphabet.idx2word = checkpoint['alphabet']['idx2word']
+  alphabet.word2idx = checkpoint['alphabet']['word2idx']
+
+  return checkpoint['model_config'], region_map, alphabet, params, forward
+
+
+class ModelRegistry:
+  """Thread-safe, lazily populated cache of loaded checkpoints.
+
+  Models are registered under a name and looked up either by that name or by
+  the checkpoint path. Loading happens outside the registry lock, with one lock
+  per checkpoint, so a slow load of one model does not block lookups of models
+  that are already resident, and concurrent first requests for the same model
+  wait for a single load instead of each unpickling their own copy.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._paths = {}  # name -> path
+    self._models = {}  # path -> LoadedModel
+    self._load_locks = {}  # path -> threading.Lock
+
+  def register(self, name: str, path: str) -> None:
+    """Associates `name` with the checkpoint at `path` without loading it."""
+    path = os.path.abspath(path)
+    with self._lock:
+      if self._paths.get(name, path) != path:
+        raise ValueError(
+            f'Model {name!r} is already registered to {self._paths[name]}.')
+      self._paths[name] = path
+
+  def names(self) -> Sequence[str]:
+    with self._lock:
+      return list(self._paths)
+
+  def _resolve(self, name_or_path: str):
+    with self._lock:
+      if name_or_path in self._paths:
+        return name_or_path, self._paths[name_or_path]
+    path = os.path.abspath(name_or_path)
+    if not os.path.exists(path):
+      raise KeyError(f'Unknown model {name_or_path!r}.')
+    with self._lock:
+      for name, registered_path in self._paths.items():
+        if registered_path == path:
+          return name, path
+    return name_or_path, path
+
+  def get(self, name_or_path: str) -> LoadedModel:
+    """Returns the loaded model, loading it on first use."""
+    name, path = self._resolve(name_or_path)
+    with self._lock:
+      model = self._models.get(path)
+      if model is not None:
+        return model
+      load_lock = self._load_locks.setdefault(path, threading.Lock())
+
+    with load_lock:
+      # Another thread may have finished loading while we were waiting.
+      with self._lock:
+        model = self._models.get(path)
+      if model is None:
+        (model_config, region_map, alphabet, params,
+         forward) = load_checkpoint(path)
+        model = LoadedModel(
+            name=name,
+            path=path,
+            model_config=model_config,
+            region_map=region_map,
+            alphabet=alphabet,
+            params=params,
+            forward=forward)
+        with self._lock:
+          self._models[path] = model
+    return model
+
+  def is_loaded(self, name_or_path: str) -> bool:
+    try:
+      _, path = self._resolve(name_or_path)
+    except KeyError:
+      return False
+    with self._lock:
+      return path in self._models
+
+  def warmup(self,
+             names: Optional[Sequence[str]] = None,
+             length_buckets: Optional[Sequence[int]] = None) -> None:
+    """Loads the given (default: all registered) models and compiles them.
+
+    Runs one forward pass at the fixed model sequence length, and at each of
+    `length_buckets` if given, so that the first request does not pay the
+    compilation cost.
+    """
+    seq_lens = sorted(set(length_buckets or ()) | {inference.TEXT_LEN})
+    for name in names if names is not None else self.names():
+      model = self.get(name)
+      for seq_len in seq_lens:
+        text_char = np.zeros((1, seq_len), dtype=np.int32)
+        text_char[0, 0] = model.alphabet.sos_idx
+        outputs = model.forward(
+            text_char=text_char,
+            text_word=np.zeros_like(text_char),
+            rngs={'dropout': jax.random.PRNGKey(inference.SEED)},
+            is_training=False)
+        jax.tree_util.tree_map(lambda x: x.block_until_ready(), outputs)
+
+  def clear(self) -> None:
+    """Drops all loaded models; registrations are kept."""
+    with self._lock:
+      self._models.clear()
+      self._load_locks.clear()
+
+
+_REGISTRY = ModelRegistry()
+
+register = _REGISTRY.register
+get = _REGISTRY.get
+is_loaded = _REGISTRY.is_loaded
+warmup = _REGISTRY.warmup
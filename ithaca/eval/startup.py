@@ -0,0 +1,292 @@
+# Copyright 2021 the Ithaca Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Startup of inference servers: checkpoint download, loading and warm-up.
+
+`ModelLoader` fetches the checkpoint into a local cache directory (skipping
+the download if the cached copy is intact), loads it into the registry and
+compiles it on a background thread, timing each phase. The server can start
+accepting requests, and answer health checks through `serve_health()`,
+immediately; request handlers call `ModelLoader.wait()` before using the
+model.
+
+This module does not import JAX, which is only imported by the loader thread.
+"""
+
+import contextlib
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import Any, Callable, Dict, Optional
+
+from absl import logging
+
+_CHUNK_SIZE = 1 << 20
+
+
+class PhaseTimer:
+  """Records the wall time of named startup phases."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._start = time.monotonic()
+    self._timings = {}
+
+  @contextlib.contextmanager
+  def phase(self, name: str):
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      elapsed = time.monotonic() - start
+      with self._lock:
+        self._timings[name] = elapsed
+      logging.info('Startup phase %s took %.2fs.', name, elapsed)
+
+  def timings(self) -> Dict[str, float]:
+    """Returns the duration of every finished phase, in seconds."""
+    with self._lock:
+      return dict(self._timings)
+
+  def elapsed(self) -> float:
+    return time.monotonic() - self._start
+
+
+def sha256sum(path: str) -> str:
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _verified(path: str, sha256: Optional[str]) -> bool:
+  """Whether `path` is a complete download with the expected checksum.
+
+  The checksum of a download is recorded next to it, together with its size
+  and modification time, so that later starts only hash the file again if it
+  was modified.
+  """
+  record_path = path + '.sha256'
+  if not os.path.exists(path) or not os.path.exists(record_path):
+    return False
+  try:
+    with open(record_path) as f:
+      record = json.load(f)
+    recorded_sha256, size, mtime_ns = (record['sha256'], record['size'],
+                                       record['mtime_ns'])
+  except (KeyError, TypeError, ValueError) as e:
+    logging.warning('Ignoring unreadable checksum record %s: %r.', record_path,
+                    e)
+    return False
+  stat = os.stat(path)
+  if sha256 is not None and recorded_sha256 != sha256:
+    return False
+  if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+    return True
+  return sha256sum(path) == recorded_sha256
+
+
+def _write_record(path: str, digest: str) -> None:
+  """Records the checksum of `path` for _verified()."""
+  stat = os.stat(path)
+  record_path = path + '.sha256'
+  # Written next to the destination and renamed, like the download itself.
+  with tempfile.NamedTemporaryFile(
+      'w', dir=os.path.dirname(record_path), delete=False) as f:
+    json.dump({'sha256': digest, 'size': stat.st_size,
+               'mtime_ns': stat.st_mtime_ns}, f)
+  os.replace(f.name, record_path)
+
+
+def fetch(url: str, cache_dir: str, sha256: Optional[str] = None) -> str:
+  """Returns the path of a verified local copy of `url`, downloading it once.
+
+  Args:
+    url: URL of the file, e.g. a checkpoint.
+    cache_dir: directory the file is cached in, under its base name.
+    sha256: expected hex digest. If None, the digest of the first download
+      is recorded and later copies are checked against it; only downloads
+      shorter than their Content-Length are then detected.
+
+  Raises:
+    ValueError: if the download is incomplete or does not have the expected
+      checksum.
+  """
+  os.makedirs(cache_dir, exist_ok=True)
+  path = os.path.join(cache_dir, os.path.basename(url))
+  if _verified(path, sha256):
+    logging.info('Using cached %s.', path)
+    return path
+
+  logging.info('Downloading %s to %s.', url, path)
+  # Download next to the destination and rename, so that an interrupted
+  # download never leaves a partial file under the final name.
+  with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+    tmp_path = f.name
+    try:
+      with urllib.request.urlopen(url) as response:
+        shutil.copyfileobj(response, f, _CHUNK_SIZE)
+        expected_size = response.headers.get('Content-Length')
+      size = f.tell()
+    except BaseException:
+      os.remove(tmp_path)
+      raise
+  # A connection closed early ends the copy without an error.
+  if expected_size is not None and size != int(expected_size):
+    os.remove(tmp_path)
+    raise ValueError(f'Incomplete download of {url}: got {size} of '
+                     f'{expected_size} bytes.')
+  if sha256 is None:
+    logging.warning('No expected checksum for %s; trusting this download.',
+                    url)
+  digest = sha256sum(tmp_path)
+  if sha256 is not None and digest != sha256:
+    os.remove(tmp_path)
+    raise ValueError(f'Checksum mismatch for {url}: expected {sha256}, '
+                     f'got {digest}.')
+  os.replace(tmp_path, path)
+  _write_record(path, digest)
+  return path
+
+
+class ModelLoader:
+  """Loads and warms a model on a background thread.
+
+  Attributes:
+    name: registry name of the model.
+    timer: timings of the startup phases.
+  """
+
+  def __init__(self,
+               name: str,
+               url: str,
+               cache_dir: str,
+               sha256: Optional[str] = None,
+               compile_cache_dir: Optional[str] = None,
+               on_ready: Optional[Callable[[Any], Any]] = None):
+    """Creates the loader; call start() to begin loading.
+
+    Args:
+      name: name to register the model under.
+      url: URL of the checkpoint.
+      cache_dir: local directory the checkpoint is cached in.
+      sha256: expected checksum of the checkpoint, if known.
+      compile_cache_dir: optional persistent compilation cache directory.
+      on_ready: called with the `registry.LoadedModel` after warm-up; its
+        return value is available as `result`.
+    """
+    self.name = name
+    self.timer = PhaseTimer()
+    self._url = url
+    self._cache_dir = cache_dir
+    self._sha256 = sha256
+    self._compile_cache_dir = compile_cache_dir
+    self._on_ready = on_ready
+    self._ready = threading.Event()
+    self._error = None
+    self._result = None
+    self._thread = threading.Thread(
+        target=self._load, name='ModelLoader', daemon=True)
+
+  def start(self) -> 'ModelLoader':
+    self._thread.start()
+    return self
+
+  def _load(self):
+    try:
+      with self.timer.phase('download'):
+        path = fetch(self._url, self._cache_dir, self._sha256)
+      with self.timer.phase('import'):
+        # pylint: disable=g-import-not-at-top
+        from ithaca.eval import compile_cache
+        from ithaca.eval import registry
+        # pylint: enable=g-import-not-at-top
+      if self._compile_cache_dir is not None:
+        compile_cache.enable(self._compile_cache_dir)
+      with self.timer.phase('load'):
+        registry.register(self.name, path)
+        model = registry.get(self.name)
+      with self.timer.phase('warmup'):
+        registry.warmup([self.name])
+      if self._on_ready is not None:
+        self._result = self._on_ready(model)
+      logging.info('Model %s ready after %.2fs: %s.', self.name,
+                   self.timer.elapsed(), self.timer.timings())
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception('Loading model %s failed.', self.name)
+      self._error = e
+    finally:
+      self._ready.set()
+
+  def wait(self, timeout: Optional[float] = None) -> Any:
+    """Blocks until the model is ready, and returns the on_ready() result.
+
+    Raises:
+      TimeoutError: if the model is not ready after `timeout` seconds.
+      RuntimeError: if loading failed.
+    """
+    if not self._ready.wait(timeout):
+      raise TimeoutError(f'Model {self.name} is still loading.')
+    if self._error is not None:
+      raise RuntimeError(f'Model {self.name} failed to load.') from self._error
+    return self._result
+
+  def health(self) -> Dict[str, Any]:
+    """Returns the loading status and phase timings."""
+    if not self._ready.is_set():
+      status = 'loading'
+    elif self._error is not None:
+      status = 'failed'
+    else:
+      status = 'ready'
+    return {
+        'status': status,
+        'uptime': self.timer.elapsed(),
+        'phases': self.timer.timings(),
+    }
+
+
+def serve_health(loader: ModelLoader,
+                 port: int,
+                 host: str = '') -> http.server.HTTPServer:
+  """Serves `loader.health()` as JSON on a background thread.
+
+  Responds with 200 once the model is ready and 503 before, so the server can
+  be used as both liveness (any response) and readiness (200) check.
+  """
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):  # pylint: disable=invalid-name
+      health = loader.health()
+      body = json.dumps(health).encode('utf-8')
+      self.send_response(200 if health['status'] == 'ready' else 503)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):  # Requests are too frequent to log.
+      pass
+
+  server = http.server.ThreadingHTTPServer((host, port), Handler)
+  threading.Thread(
+      target=server.serve_forever, name='HealthServer', daemon=True).start()
+  return server
@@ -29,7 +29,7 @@ import jax.numpy as jnp
 import numpy as np
 
 
-def get_block_rand_mask(m, n, wm, wn, r, last_idx=-1):
+def get_block_rand_mask(m, n, wm, wn, r, last_idx=-1, rng=None):
   """This function creates the m by n mask for random block sparse mask.
 
   Args:
@@ -40,10 +40,13 @@ def get_block_rand_mask(m, n, wm, wn, r, last_idx=-1):
     r: number of random block per row
     last_idx: if -1 then r blocks are chosen throughout the n space, if
       possitive then r blocks are chooses at random upto last_ids
+    rng: np.random.RandomState to draw from; the global NumPy RNG if None.
 
   Returns:
     blocked mask of size m//wm -2 by r
   """
+  if rng is None:
+    rng = np.random
   if (m // wm) != (n // wn):
     logging.info('Error the number of blocks needs to be same')
   rand_attn = np.zeros((m // wm - 2, r), dtype=jnp.int64)
@@ -55,26 +58,66 @@ def get_block_rand_mask(m, n, wm, wn, r, last_idx=-1):
     start = i - 2
     end = i
     if i == 1:
-      rand_attn[i - 1, :] = np.random.permutation(a[2:last])[:r]
+      rand_attn[i - 1, :] = rng.permutation(a[2:last])[:r]
     elif i == 2:
-      rand_attn[i - 1, :] = np.random.permutation(a[3:last])[:r]
+      rand_attn[i - 1, :] = rng.permutation(a[3:last])[:r]
     elif i == m // wm - 3:
-      rand_attn[i - 1, :] = np.random.permutation(a[:last - 4])[:r]
+      rand_attn[i - 1, :] = rng.permutation(a[:last - 4])[:r]
     elif i == m // wm - 2:
-      rand_attn[i - 1, :] = np.random.permutation(a[:last - 3])[:r]
+      rand_attn[i - 1, :] = rng.permutation(a[:last - 3])[:r]
     else:
       if start > last:
         start = last
-        rand_attn[i - 1, :] = np.random.permutation(a[:start])[:r]
+        rand_attn[i - 1, :] = rng.permutation(a[:start])[:r]
       elif (end + 1) == last:
-        rand_attn[i - 1, :] = np.random.permutation(a[:start])[:r]
+        rand_attn[i - 1, :] = rng.permutation(a[:start])[:r]
       else:
-        rand_attn[i - 1, :] = np.random.permutation(
+        rand_attn[i - 1, :] = rng.permutation(
             np.concatenate((a[:start], a[end + 1:last])))[:r]
   return rand_attn
 
 
-def create_band_mask_from_inputs(from_blocked_mask, to_blocked_mask):
+@functools.lru_cache(maxsize=None)
+def get_rand_attn(seq_length, block_size, num_rand_blocks, num_heads,
+                  connectivity_seed):
+  """Returns the random block connectivity of one attention layer.
+
+  The connectivity only depends on the arguments, so it is computed once per
+  layer configuration and reused by every forward pass. A private RandomState
+  seeded with `connectivity_seed` draws the same permutations as seeding the
+  global NumPy RNG did, without touching the global state.
+
+  Args:
+    seq_length: (block-padded) sequence length.
+    block_size: size of attention blocks.
+    num_rand_blocks: number of random blocks per row.
+    num_heads: number of attention heads.
+    connectivity_seed: seed for generating the connectivity graph.
+
+  Returns:
+    read-only int array of shape
+    [num_heads, seq_length // block_size - 2, num_rand_blocks].
+  """
+  rng = np.random.RandomState(connectivity_seed)
+  # pylint: disable=g-complex-comprehension
+  rand_attn = np.stack([
+      get_block_rand_mask(
+          seq_length,
+          seq_length,
+          block_size,
+          block_size,
+          num_rand_blocks,
+          last_idx=min(seq_length, 1024),
+          rng=rng) for _ in range(num_heads)
+  ]).astype(np.int32)
+  # pylint: enable=g-complex-comprehension
+  rand_attn.setflags(write=False)
+  return rand_attn
+
+
+def create_band_mask_from_inputs(from_blocked_mask,
+                                 to_blocked_mask,
+                                 virtual_last_block=False):
   """Create 3D attention mask from a 2D tensor mask.
 
   Args:
@@ -82,22 +125,34 @@ def create_band_mask_from_inputs(from_blocked_mask, to_blocked_mask):
       from_seq_length//from_block_size, from_block_size].
     to_blocked_mask: int32 Tensor of shape [batch_size,
       to_seq_length//to_block_size, to_block_size].
+    virtual_last_block: whether the masks omit a final, fully padded block (see
+      band_start_block_rand_multi_attention_pad).
 
   Returns:
     float Tensor of shape [batch_size, 1, from_seq_length//from_block_size-4,
-                           from_block_size,  3*to_block_size].
+                           from_block_size,  3*to_block_size], with one block
+                           fewer removed if `virtual_last_block`.
   """
-  exp_blocked_to_pad = jnp.concatenate([
-      to_blocked_mask[:, 1:-3], to_blocked_mask[:, 2:-2], to_blocked_mask[:,
-                                                                          3:-1]
-  ], 2)
-  band_pad = jnp.einsum('BLQ,BLK->BLQK', from_blocked_mask[:, 2:-2],
-                        exp_blocked_to_pad)
+  if virtual_last_block:
+    exp_blocked_to_pad = jnp.concatenate(
+        [to_blocked_mask[:, 1:-2], to_blocked_mask[:, 2:-1],
+         to_blocked_mask[:, 3:]], 2)
+    from_blocked_mask = from_blocked_mask[:, 2:-1]
+  else:
+    exp_blocked_to_pad = jnp.concatenate([
+        to_blocked_mask[:, 1:-3], to_blocked_mask[:, 2:-2],
+        to_blocked_mask[:, 3:-1]
+    ], 2)
+    from_blocked_mask = from_blocked_mask[:, 2:-2]
+  band_pad = jnp.einsum('BLQ,BLK->BLQK', from_blocked_mask, exp_blocked_to_pad)
   band_pad = jnp.expand_dims(band_pad, 1)
   return band_pad
 
 
-def create_rand_mask_from_inputs(from_blocked_mask, to_blocked_mask, rand_attn):
+def create_rand_mask_from_inputs(from_blocked_mask,
+                                 to_blocked_mask,
+                                 rand_attn,
+                                 virtual_last_block=False):
   """Create 3D attention mask from a 2D tensor mask.
 
   Args:
@@ -107,6 +162,8 @@ def create_rand_mask_from_inputs(from_blocked_mask, to_blocked_mask, rand_attn):
       to_seq_length//to_block_size, to_block_size].
     rand_attn: [batch_size, num_attention_heads,
       from_seq_length//from_block_size-2, rsize]
+    virtual_last_block: whether the masks omit a final, fully padded block (see
+      band_start_block_rand_multi_attention_pad).
 
   Returns:
     float Tensor of shape [batch_size, num_attention_heads,
@@ -121,7 +178,10 @@ def create_rand_mask_from_inputs(from_blocked_mask, to_blocked_mask, rand_attn):
       # Equivalent to tf.gather(to_blocked_mask, rand_attn, batch_dims=1)
       gather_1(to_blocked_mask, rand_attn),
       [batch_size, num_attention_heads, num_windows, -1])
-  rand_pad = jnp.einsum('BLQ,BHLK->BHLQK', from_blocked_mask[:, 1:-1], rand_pad)
+  from_blocked_mask = (
+      from_blocked_mask[:, 1:]
+      if virtual_last_block else from_blocked_mask[:, 1:-1])
+  rand_pad = jnp.einsum('BLQ,BHLK->BHLQK', from_blocked_mask, rand_pad)
   return rand_pad
 
 
@@ -135,12 +195,46 @@ def gather_2(params, indices):
   return gather_1(params, indices)
 
 
-def band_start_block_rand_multi_attention_pad(query_matrix, key_matrix,
-                                              value_matrix, rand_attn, band_pad,
-                                              rand_pad, seq_m_pad, seq_n_pad, b,
-                                              h, m, wm, n, wn, r, d):
+def segment_mask(query_segment_ids, key_segment_ids):
+  """Additive mask of query/key pairs from different (packed) segments.
+
+  Args:
+    query_segment_ids: [..., q] segment ids of the queries.
+    key_segment_ids: [..., k] segment ids of the keys.
+
+  Returns:
+    float Tensor of shape [..., q, k], -10000 where the segments differ.
+  """
+  return jnp.not_equal(query_segment_ids[..., :, None],
+                       key_segment_ids[..., None, :]) * -10000.0
+
+
+def band_start_block_rand_multi_attention_pad(query_matrix,
+                                              key_matrix,
+                                              value_matrix,
+                                              rand_attn,
+                                              band_pad,
+                                              rand_pad,
+                                              seq_m_pad,
+                                              seq_n_pad,
+                                              b,
+                                              h,
+                                              m,
+                                              wm,
+                                              n,
+                                              wn,
+                                              r,
+                                              d,
+                                              virtual_last_block=False,
+                                              segment_ids=None):
   """Applies sparse block band rand attention in hopefully efficient way.
 
+  With `virtual_last_block`, the inputs stand for a sequence with one more
+  block at the end whose keys are all masked out. That block is not
+  materialized: it only contributes zero attention weights to the other blocks,
+  and its own (padding) outputs are not needed. The result is that of the
+  longer sequence, without the last block, at the cost of the shorter one.
+
   Args:
     query_matrix: b, h, n, d
     key_matrix: b, h, n, d
@@ -158,6 +252,11 @@ def band_start_block_rand_multi_attention_pad(query_matrix, key_matrix,
     wn: to window size
     r: number of rand blocks
     d: hidden dimension
+    virtual_last_block: whether the last (global) block is omitted from the
+      inputs, in which case rand_attn, band_pad and rand_pad have one block
+      more than m//wm-2, m//wm-4 and m//wm-2 respectively.
+    segment_ids: optional [b, m] ids of packed segments; attention is then
+      restricted to pairs of tokens of the same segment.
 
   Returns:
     context layer. b, m, h, -1
@@ -167,63 +266,93 @@ def band_start_block_rand_multi_attention_pad(query_matrix, key_matrix,
   blocked_key_matrix = jnp.reshape(key_matrix, (b, h, n // wn, wn, -1))
   blocked_value_matrix = jnp.reshape(value_matrix, (b, h, n // wn, wn, -1))
   # tf.gather(blocked_key_matrix, rand_attn, batch_dims=2, name='gather_key'),
+  num_rand_rows = rand_attn.shape[2]
   gathered_key = jnp.reshape(
       gather_2(blocked_key_matrix, rand_attn),
-      (b, h, m // wm - 2, r * wn, -1))  # [b, h, n//wn-2, r, wn, -1]
+      (b, h, num_rand_rows, r * wn, -1))  # [b, h, n//wn-2, r, wn, -1]
   # tf.gather(
   #   blocked_value_matrix, rand_attn, batch_dims=2, name='gather_value')
   gathered_value = jnp.reshape(
       gather_2(blocked_value_matrix, rand_attn),
-      (b, h, m // wm - 2, r * wn, -1))  # [b, h, n//wn-2, r, wn, -1]
+      (b, h, num_rand_rows, r * wn, -1))  # [b, h, n//wn-2, r, wn, -1]
+  # Slices of the last (global) block and of the blocks before it.
+  if virtual_last_block:
+    last_blocks = []
+    end = None
+  else:
+    last_blocks = [-1]
+    end = -1
+  num_band_blocks = 3 + len(last_blocks)
+  if segment_ids is not None:
+    blocked_segment_ids = jnp.reshape(segment_ids, (b, 1, m // wm, wm))
+    gathered_segment_ids = jnp.reshape(
+        gather_2(
+            jnp.broadcast_to(blocked_segment_ids, (b, h, m // wm, wm)),
+            rand_attn), (b, h, num_rand_rows, r * wn))
+
+  def key_segment_ids(blocks, rand_row):
+    """Segment ids of the keys of one global-ish query block."""
+    keys = jnp.concatenate([blocked_segment_ids[:, :, i] for i in blocks], 2)
+    keys = jnp.broadcast_to(keys, (b, h, keys.shape[2]))
+    return jnp.concatenate([keys, gathered_segment_ids[:, :, rand_row]], 2)
 
   first_product = jnp.einsum(
       'BHQD,BHKD->BHQK', blocked_query_matrix[:, :, 0],
       key_matrix)  # [b, h, wm, -1] x [b, h, n, -1] ==> [b, h, wm, n]
   first_product = first_product / jnp.sqrt(d)
   first_product += (1.0 - seq_n_pad) * -10000.0
+  if segment_ids is not None:
+    first_product += segment_mask(blocked_segment_ids[:, :, 0],
+                                  segment_ids[:, None])
   first_attn_weights = jax.nn.softmax(first_product)  # [b, h, wm, n]
   first_context_layer = jnp.einsum(
       'BHQK,BHKD->BHQD', first_attn_weights,
       value_matrix)  # [b, h, wm, n] x [b, h, n, -1] ==> [b, h, wm, -1]
   first_context_layer = jnp.expand_dims(first_context_layer, 2)
 
-  second_key_mat = jnp.concatenate([
-      blocked_key_matrix[:, :, 0], blocked_key_matrix[:, :, 1],
-      blocked_key_matrix[:, :, 2], blocked_key_matrix[:, :,
-                                                      -1], gathered_key[:, :, 0]
-  ], 2)  # [b, h, (4+r)*wn, -1]
-  second_value_mat = jnp.concatenate([
-      blocked_value_matrix[:, :, 0], blocked_value_matrix[:, :, 1],
-      blocked_value_matrix[:, :, 2], blocked_value_matrix[:, :, -1],
-      gathered_value[:, :, 0]
-  ], 2)  # [b, h, (4+r)*wn, -1]
+  second_key_mat = jnp.concatenate(
+      [blocked_key_matrix[:, :, i] for i in [0, 1, 2] + last_blocks] +
+      [gathered_key[:, :, 0]], 2)  # [b, h, (4+r)*wn, -1]
+  second_value_mat = jnp.concatenate(
+      [blocked_value_matrix[:, :, i] for i in [0, 1, 2] + last_blocks] +
+      [gathered_value[:, :, 0]], 2)  # [b, h, (4+r)*wn, -1]
   second_product = jnp.einsum(
       'BHQD,BHKD->BHQK', blocked_query_matrix[:, :, 1], second_key_mat
   )  # [b, h, wm, -1] x [b, h, (4+r)*wn, -1] ==> [b, h, wm, (4+r)*wn]
-  second_seq_pad = jnp.concatenate([
-      seq_n_pad[:, :, :, :3 * wn], seq_n_pad[:, :, :, -wn:],
-      jnp.ones([b, 1, 1, r * wn], dtype=jnp.float32)
+  second_seq_pad = jnp.concatenate(
+      [seq_n_pad[:, :, :, :3 * wn]] +
+      [seq_n_pad[:, :, :, -wn:] for _ in last_blocks] +
+      [jnp.ones([b, 1, 1, r * wn], dtype=jnp.float32)], 3)
+  second_rand_pad = jnp.concatenate([
+      jnp.ones([b, h, wm, num_band_blocks * wn], dtype=jnp.float32),
+      rand_pad[:, :, 0]
   ], 3)
-  second_rand_pad = jnp.concatenate(
-      [jnp.ones([b, h, wm, 4 * wn], dtype=jnp.float32), rand_pad[:, :, 0]], 3)
   second_product = second_product / jnp.sqrt(d)
   second_product += (1.0 -
                      jnp.minimum(second_seq_pad, second_rand_pad)) * -10000.0
+  if segment_ids is not None:
+    second_product += segment_mask(
+        blocked_segment_ids[:, :, 1],
+        key_segment_ids([0, 1, 2] + last_blocks, 0))
   second_attn_weights = jax.nn.softmax(second_product)  # [b , h, wm, (4+r)*wn]
   second_context_layer = jnp.einsum(
       'BHQK,BHKD->BHQD', second_attn_weights, second_value_mat
   )  # [b, h, wm, (4+r)*wn] x [b, h, (4+r)*wn, -1] ==> [b, h, wm, -1]
   second_context_layer = jnp.expand_dims(second_context_layer, 2)
 
+  # Blocks 2 to -3 (or -2 if the last block is virtual).
+  middle = slice(2, -1 if virtual_last_block else -2)
   exp_blocked_key_matrix = jnp.concatenate([
-      blocked_key_matrix[:, :, 1:-3], blocked_key_matrix[:, :, 2:-2],
-      blocked_key_matrix[:, :, 3:-1]
+      blocked_key_matrix[:, :, 1:middle.stop - 1],
+      blocked_key_matrix[:, :, middle],
+      blocked_key_matrix[:, :, 3:end]
   ], 3)  # [b, h, m//wm-4, 3*wn, -1]
   exp_blocked_value_matrix = jnp.concatenate([
-      blocked_value_matrix[:, :, 1:-3], blocked_value_matrix[:, :, 2:-2],
-      blocked_value_matrix[:, :, 3:-1]
+      blocked_value_matrix[:, :, 1:middle.stop - 1],
+      blocked_value_matrix[:, :, middle],
+      blocked_value_matrix[:, :, 3:end]
   ], 3)  # [b, h, m//wm-4, 3*wn, -1]
-  middle_query_matrix = blocked_query_matrix[:, :, 2:-2]
+  middle_query_matrix = blocked_query_matrix[:, :, middle]
   inner_band_product = jnp.einsum(
       'BHLQD,BHLKD->BHLQK', middle_query_matrix, exp_blocked_key_matrix
   )  # [b, h, m//wm-4, wm, -1] x [b, h, m//wm-4, 3*wn, -1]
@@ -239,20 +368,37 @@ def band_start_block_rand_multi_attention_pad(query_matrix, key_matrix,
       'BHLQD,BHKD->BHLQK', middle_query_matrix, blocked_key_matrix[:, :, 0]
   )  # [b, h, m//wm-4, wm, -1] x [b, h, wn, -1] ==> [b, h, m//wm-4, wm, wn]
   first_band_product = first_band_product / jnp.sqrt(d)
-  last_band_product = jnp.einsum(
-      'BHLQD,BHKD->BHLQK', middle_query_matrix, blocked_key_matrix[:, :, -1]
-  )  # [b, h, m//wm-4, wm, -1] x [b, h, wn, -1] ==> [b, h, m//wm-4, wm, wn]
-  last_band_product = last_band_product / jnp.sqrt(d)
+  last_band_products = []
+  for i in last_blocks:
+    last_band_product = jnp.einsum(
+        'BHLQD,BHKD->BHLQK', middle_query_matrix, blocked_key_matrix[:, :, i]
+    )  # [b, h, m//wm-4, wm, -1] x [b, h, wn, -1] ==> [b, h, m//wm-4, wm, wn]
+    last_band_product = last_band_product / jnp.sqrt(d)
+    last_band_product += (
+        1.0 - jnp.expand_dims(seq_n_pad[:, :, :, -wn:], 3)) * -10000.0
+    last_band_products.append(last_band_product)
   inner_band_product += (1.0 - band_pad) * -10000.0
   first_band_product += (1.0 -
                          jnp.expand_dims(seq_n_pad[:, :, :, :wn], 3)) * -10000.0
-  last_band_product += (1.0 -
-                        jnp.expand_dims(seq_n_pad[:, :, :, -wn:], 3)) * -10000.0
   rand_band_product += (1.0 - rand_pad[:, :, 1:-1]) * -10000.0
   band_product = jnp.concatenate([
-      first_band_product, inner_band_product, rand_band_product,
-      last_band_product
-  ], -1)  # [b, h, m//wm-4, wm, (5+r)*wn]
+      first_band_product, inner_band_product, rand_band_product
+  ] + last_band_products, -1)  # [b, h, m//wm-4, wm, (5+r)*wn]
+  if segment_ids is not None:
+    middle_rows = middle_query_matrix.shape[2]
+    band_segment_ids = [
+        blocked_segment_ids[:, :, :1],
+        jnp.concatenate([
+            blocked_segment_ids[:, :, 1:middle.stop - 1],
+            blocked_segment_ids[:, :, middle], blocked_segment_ids[:, :, 3:end]
+        ], 3), gathered_segment_ids[:, :, 1:-1]
+    ] + [blocked_segment_ids[:, :, i][:, :, None] for i in last_blocks]
+    band_segment_ids = jnp.concatenate([
+        jnp.broadcast_to(x, (b, h, middle_rows, x.shape[3]))
+        for x in band_segment_ids
+    ], 3)
+    band_product += segment_mask(blocked_segment_ids[:, :, middle],
+                                 band_segment_ids)
   attn_weights = jax.nn.softmax(band_product)  # [b, h, m//wm-4, wm, (5+r)*wn]
   context_layer = jnp.einsum(
       'BHLQK,BHLKD->BHLQD', attn_weights[:, :, :, :,
@@ -260,41 +406,48 @@ def band_start_block_rand_multi_attention_pad(query_matrix, key_matrix,
   )  # [b, h, m//wm-4, wm, 3*wn] x [b, h, m//wm-4, 3*wn, -1]
   #     ==> [b, h, m//wm-4, wm, -1]
   context_layer += jnp.einsum(
-      'BHLQK,BHLKD->BHLQD', attn_weights[:, :, :, :,
-                                         4 * wn:-wn], gathered_value[:, :, 1:-1]
+      'BHLQK,BHLKD->BHLQD', attn_weights[:, :, :, :, 4 * wn:(4 + r) * wn],
+      gathered_value[:, :, 1:-1]
   )  # [b, h, m//wm-4, wm, r*wn] x [b, h, m//wm-4, r*wn, -1]
   #     ==> [b, h, m//wm-4, wm, -1]
   context_layer += jnp.einsum(
       'BHLQK,BHKD->BHLQD', attn_weights[:, :, :, :, :wn],
       blocked_value_matrix[:, :, 0]
   )  # [b, h, m//wm-4, wm, wn] x [b, h, wn, -1] ==> [b, h, m//wm-4, wm, -1]
-  context_layer += jnp.einsum(
-      'BHLQK,BHKD->BHLQD', attn_weights[:, :, :, :,
-                                        -wn:], blocked_value_matrix[:, :, -1]
-  )  # [b, h, m//wm-4, wm, wn] x [b, h, wn, -1] ==> [b, h, m//wm-4, wm, -1]
-
-  second_last_key_mat = jnp.concatenate([
-      blocked_key_matrix[:, :, 0], blocked_key_matrix[:, :, -3],
-      blocked_key_matrix[:, :, -2], blocked_key_matrix[:, :, -1],
-      gathered_key[:, :, -1]
-  ], 2)  # [b, h, (4+r)*wn, -1]
-  second_last_value_mat = jnp.concatenate([
-      blocked_value_matrix[:, :, 0], blocked_value_matrix[:, :, -3],
-      blocked_value_matrix[:, :, -2], blocked_value_matrix[:, :, -1],
-      gathered_value[:, :, -1]
-  ], 2)  # [b, h, (4+r)*wn, -1]
+  for i in last_blocks:
+    context_layer += jnp.einsum(
+        'BHLQK,BHKD->BHLQD', attn_weights[:, :, :, :, -wn:],
+        blocked_value_matrix[:, :, i]
+    )  # [b, h, m//wm-4, wm, wn] x [b, h, wn, -1] ==> [b, h, m//wm-4, wm, -1]
+
+  # Blocks -3 and -2 (or -2 and -1 if the last block is virtual).
+  second_last = -1 if virtual_last_block else -2
+  second_last_blocks = [0, second_last - 1, second_last] + last_blocks
+  second_last_key_mat = jnp.concatenate(
+      [blocked_key_matrix[:, :, i] for i in second_last_blocks] +
+      [gathered_key[:, :, -1]], 2)  # [b, h, (4+r)*wn, -1]
+  second_last_value_mat = jnp.concatenate(
+      [blocked_value_matrix[:, :, i] for i in second_last_blocks] +
+      [gathered_value[:, :, -1]], 2)  # [b, h, (4+r)*wn, -1]
   second_last_product = jnp.einsum(
-      'BHQD,BHKD->BHQK', blocked_query_matrix[:, :, -2], second_last_key_mat
+      'BHQD,BHKD->BHQK', blocked_query_matrix[:, :, second_last],
+      second_last_key_mat
   )  # [b, h, wm, -1] x [b, h, (4+r)*wn, -1] ==> [b, h, wm, (4+r)*wn]
   second_last_seq_pad = jnp.concatenate([
-      seq_n_pad[:, :, :, :wn], seq_n_pad[:, :, :, -3 * wn:],
+      seq_n_pad[:, :, :, :wn], seq_n_pad[:, :, :, -(num_band_blocks - 1) * wn:],
       jnp.ones([b, 1, 1, r * wn], dtype=jnp.float32)
   ], 3)
-  second_last_rand_pad = jnp.concatenate(
-      [jnp.ones([b, h, wm, 4 * wn], dtype=jnp.float32), rand_pad[:, :, -1]], 3)
+  second_last_rand_pad = jnp.concatenate([
+      jnp.ones([b, h, wm, num_band_blocks * wn], dtype=jnp.float32),
+      rand_pad[:, :, -1]
+  ], 3)
   second_last_product = second_last_product / jnp.sqrt(d)
   second_last_product += (
       1.0 - jnp.minimum(second_last_seq_pad, second_last_rand_pad)) * -10000.0
+  if segment_ids is not None:
+    second_last_product += segment_mask(
+        blocked_segment_ids[:, :, second_last],
+        key_segment_ids(second_last_blocks, -1))
   second_last_attn_weights = jax.nn.softmax(
       second_last_product)  # [b, h, wm, (4+r)*wn]
   second_last_context_layer = jnp.einsum(
@@ -302,21 +455,31 @@ def band_start_block_rand_multi_attention_pad(query_matrix, key_matrix,
   )  # [b, h, wm, (4+r)*wn] x [b, h, (4+r)*wn, -1] ==> [b, h, wm, -1]
   second_last_context_layer = jnp.expand_dims(second_last_context_layer, 2)
 
+  context_layers = [
+      first_context_layer, second_context_layer, context_layer,
+      second_last_context_layer
+  ]
+  if virtual_last_block:
+    context_layer = jnp.concatenate(context_layers, 2)
+    context_layer = jnp.reshape(context_layer, (b, h, m, -1)) * seq_m_pad
+    context_layer = jnp.transpose(context_layer, (0, 2, 1, 3))
+    return context_layer, attn_weights
+
   last_product = jnp.einsum(
       'BHQD,BHKD->BHQK', blocked_query_matrix[:, :, -1],
       key_matrix)  # [b, h, wm, -1] x [b, h, n, -1] ==> [b, h, wm, n]
   last_product = last_product / jnp.sqrt(d)
   last_product += (1.0 - seq_n_pad) * -10000.0
+  if segment_ids is not None:
+    last_product += segment_mask(blocked_segment_ids[:, :, -1],
+                                 segment_ids[:, None])
   last_attn_weights = jax.nn.softmax(last_product)  # [b, h, wm, n]
   last_context_layer = jnp.einsum(
       'BHQK,BHKD->BHQD', last_attn_weights,
       value_matrix)  # [b, h, wm, n] x [b, h, n, -1] ==> [b, h, wm, -1]
   last_context_layer = jnp.expand_dims(last_context_layer, 2)
 
-  context_layer = jnp.concatenate([
-      first_context_layer, second_context_layer, context_layer,
-      second_last_context_layer, last_context_layer
-  ], 2)
+  context_layer = jnp.concatenate(context_layers + [last_context_layer], 2)
   context_layer = jnp.reshape(context_layer, (b, h, m, -1)) * seq_m_pad
   context_layer = jnp.transpose(context_layer, (0, 2, 1, 3))
   return context_layer, attn_weights
@@ -328,7 +491,9 @@ def sparse_dot_product_attention(queries,
                                  connectivity_seed,
                                  input_mask=None,
                                  block_size=64,
-                                 num_rand_blocks=3):
+                                 num_rand_blocks=3,
+                                 virtual_last_block=False,
+                                 segment_ids=None):
   """Implements sparse dot product attention given query, key, and value.
 
   This is the core function for applying attention based on
@@ -349,6 +514,11 @@ def sparse_dot_product_attention(queries,
       and the same dtype.
     block_size: Size for local attention around diagonal of attention.
     num_rand_blocks: int. Number of random chunks per row.
+    virtual_last_block: compute attention as if the (block-aligned) inputs were
+      followed by one more block of fully masked tokens, without materializing
+      it.
+    segment_ids: optional segment ids of packed inputs, `[batch_size, length]`;
+      tokens only attend to tokens of the same segment.
 
   Returns:
     Output of shape `[bs, length, num_heads, value_channels]`.
@@ -370,22 +540,16 @@ def sparse_dot_product_attention(queries,
         input_mask,
         tuple((0, seq_length - size) if i == 1 else (0, 0)
               for i, size in enumerate(input_mask.shape)))
+  if segment_ids is not None:
+    segment_ids = jnp.pad(segment_ids,
+                          ((0, 0), (0, seq_length - segment_ids.shape[1])))
 
-  np.random.seed(connectivity_seed)
-  # pylint: disable=g-complex-comprehension
-  rand_attn = [
-      get_block_rand_mask(
-          seq_length,
-          seq_length,
-          block_size,
-          block_size,
-          num_rand_blocks,
-          last_idx=min(seq_length, 1024)) for _ in range(num_attention_heads)
-  ]
-  # pylint: enable=g-complex-comprehension
-  rand_attn = jnp.stack(rand_attn, axis=0)
-  rand_attn = jnp.expand_dims(rand_attn, 0)
-  rand_attn = jnp.repeat(rand_attn, batch_size, 0)
+  # The random connectivity of the virtual block's sequence length; it never
+  # connects to the virtual block itself, which is always the last one.
+  rand_attn = get_rand_attn(seq_length + virtual_last_block * block_size,
+                            block_size, num_rand_blocks, num_attention_heads,
+                            connectivity_seed)
+  rand_attn = jnp.broadcast_to(rand_attn, (batch_size,) + rand_attn.shape)
 
   # reshape and cast for blocking
   blocked_input_mask = jnp.reshape(
@@ -395,9 +559,11 @@ def sparse_dot_product_attention(queries,
 
   # create band padding
   band_pad = create_band_mask_from_inputs(blocked_input_mask,
-                                          blocked_input_mask)
+                                          blocked_input_mask,
+                                          virtual_last_block)
   rand_pad = create_rand_mask_from_inputs(blocked_input_mask,
-                                          blocked_input_mask, rand_attn)
+                                          blocked_input_mask, rand_attn,
+                                          virtual_last_block)
 
   queries = jnp.transpose(queries, (0, 2, 1, 3))
   keys = jnp.transpose(keys, (0, 2, 1, 3))
@@ -407,7 +573,8 @@ def sparse_dot_product_attention(queries,
   context_layer, _ = band_start_block_rand_multi_attention_pad(
       queries, keys, values, rand_attn, band_pad, rand_pad, input_mask,
       output_mask, batch_size, num_attention_heads, seq_length, block_size,
-      seq_length, block_size, num_rand_blocks, hidden_size)
+      seq_length, block_size, num_rand_blocks, hidden_size, virtual_last_block,
+      segment_ids)
 
   return context_layer[:, :from_seq_length, ...]
 
@@ -471,22 +638,30 @@ class BigBirdAttention(nn.Module):
         self-attention, inn which case key/values will be derived from inputs_q.
       padding_mask: boolean specifying query tokens that are pad token. [b, l,
         1]
-      segmentation: segment indices for packed inputs_q data.
+      segmentation: segment indices for packed inputs_q data, [b, l]; tokens
+        only attend to tokens of the same segment.
       dropout_rng: JAX PRNGKey: to be used for dropout
 
     Returns:
       output of shape `[bs, length, features]`.
     """
 
+    # Inputs are padded with at least one block of masked tokens. For
+    # block-aligned inputs that block is not materialized; the attention is
+    # computed as if it was there.
     orig_seqlen = inputs_q.shape[-2]
-    extra_len = self.block_size - (orig_seqlen % self.block_size)
-    pad_width = np.array([[0, 0], [0, extra_len], [0, 0]])
-    mask_pad = np.array([[0, 0], [0, extra_len], [0, 0]])
-    padding_mask = jnp.pad(padding_mask, mask_pad, constant_values=-1e9)
-
-    inputs_q = jnp.pad(inputs_q, pad_width)
-    if inputs_kv is not None:
-      inputs_kv = jnp.pad(inputs_kv, pad_width)
+    extra_len = -orig_seqlen % self.block_size
+    virtual_last_block = extra_len == 0
+    if not virtual_last_block:
+      pad_width = np.array([[0, 0], [0, extra_len], [0, 0]])
+      mask_pad = np.array([[0, 0], [0, extra_len], [0, 0]])
+      padding_mask = jnp.pad(padding_mask, mask_pad, constant_values=-1e9)
+      if segmentation is not None:
+        segmentation = jnp.pad(segmentation, pad_width[:2])
+
+      inputs_q = jnp.pad(inputs_q, pad_width)
+      if inputs_kv is not None:
+        inputs_kv = jnp.pad(inputs_kv, pad_width)
 
     if inputs_kv is None:
       inputs_kv = inputs_q
@@ -528,7 +703,9 @@ class BigBirdAttention(nn.Module):
         connectivity_seed=connectivity_seed,
         input_mask=input_mask,
         block_size=self.block_size,
-        num_rand_blocks=self.num_rand_blocks)
+        num_rand_blocks=self.num_rand_blocks,
+        virtual_last_block=virtual_last_block,
+        segment_ids=segmentation)
 
     # back to the original inputs dimensions
     out = nn.DenseGeneral(
@@ -215,7 +215,13 @@ class AddPositionEmbs(nn.Module):
         raise ValueError('Wrong type value.')
     else:
       # for packed data we need to use known position indices:
-      return inputs + jnp.take(pe[0], inputs_positions, axis=0)
+      pe = jnp.take(pe[0], inputs_positions, axis=0)
+      if self.combine_type == 'add':
+        return inputs + pe
+      elif self.combine_type == 'concat':
+        return lax.concatenate([inputs, pe.astype(inputs.dtype)], 2)
+      else:
+        raise ValueError('Wrong type value.')
 
 
 class MlpBlock(nn.Module):
@@ -21,6 +21,10 @@ import jax
 import jax.numpy as jnp
 
 
+# Outputs of the model, in the order they are returned.
+OUTPUTS = ('date', 'subregion', 'mask', 'nsp')
+
+
 class Model(nn.Module):
   """Transformer Model for sequence tagging."""
   vocab_char_size: int = 164
@@ -69,8 +73,29 @@ class Model(nn.Module):
                text_char_emb=None,
                text_word_emb=None,
                padding=None,
+               inputs_segmentation=None,
+               inputs_positions=None,
+               segment_starts=None,
+               outputs=None,
+               mask_positions=None,
                is_training=True):
-    """Applies Ithaca model on the inputs."""
+    """Applies Ithaca model on the inputs.
+
+    Several texts may be packed into one row by passing `inputs_segmentation`
+    (segment ids, one per text, 0 for padding), `inputs_positions` (positions
+    restarting at 0 for each text) and `segment_starts` ([batch, segments]
+    positions of each text's first token). Attention is then restricted to
+    each text, and the date and region outputs have shape
+    [batch, segments, ...], pooled per text.
+
+    `outputs` selects which of the heads in OUTPUTS to compute (default: all);
+    the others are skipped and returned as None. `mask_positions` ([batch,
+    positions]) restricts the mask logits to the given positions, in which case
+    they have shape [batch, positions, vocab].
+    """
+    outputs = OUTPUTS if outputs is None else outputs
+    if not set(outputs) <= set(OUTPUTS):
+      raise ValueError(f'Wrong outputs: {outputs}.')
 
     if text_char is not None and padding is None:
       padding = jnp.where(text_char > 0, 1, 0)
@@ -122,8 +147,7 @@ class Model(nn.Module):
         max_len=self.max_len,
         combine_type=self.posemb_combine_type,
         name='posembed_input',
-    )(
-        x)
+    )(x, inputs_positions=inputs_positions)
     x = nn.Dropout(rate=self.dropout_rate)(x, deterministic=not is_training)
 
     # Set floating point
@@ -153,91 +177,95 @@ class Model(nn.Module):
           name=f'encoderblock_{lyr}',
       )(
           x,
+          inputs_segmentation=inputs_segmentation,
           padding_mask=padding_mask,
       )
     x = common_layers.LayerNorm(dtype=dtype, name='encoder_norm')(x)
     torso_output = x
 
+    def output_head(index, out_dim, inputs):
+      # Heads are named explicitly, as any of them may be skipped; the names
+      # are those Flax assigned when all heads were always created.
+      if self.use_output_mlp:
+        return common_layers.MlpBlock(
+            out_dim=out_dim,
+            mlp_dim=self.emb_dim,
+            dtype=dtype,
+            out_dropout=False,
+            dropout_rate=self.dropout_rate,
+            deterministic=not is_training,
+            activation_fn=self.activation_fn,
+            name=f'MlpBlock_{index}')(
+                inputs)
+      else:
+        return nn.Dense(out_dim, name=f'Dense_{index}')(inputs)
+
     # Bert logits
-    if self.use_output_mlp:
-      x_mask = common_layers.MlpBlock(
-          out_dim=self.word_char_emb_dim,
-          mlp_dim=self.emb_dim,
-          dtype=dtype,
-          out_dropout=False,
-          dropout_rate=self.dropout_rate,
-          deterministic=not is_training,
-          activation_fn=self.activation_fn)(
-              x)
-    else:
-      x_mask = nn.Dense(self.word_char_emb_dim)(x)
+    logits_mask = None
+    if 'mask' in outputs:
+      x_mask = x
+      if mask_positions is not None:
+        x_mask = jnp.take_along_axis(x, mask_positions[..., None], axis=1)
+      x_mask = output_head(0, self.word_char_emb_dim, x_mask)
 
-    char_embeddings = self.text_char_emb.embedding
-    char_embeddings = nn.Dropout(rate=self.dropout_rate)(
-        char_embeddings, deterministic=not is_training)
-    logits_mask = jnp.matmul(x_mask, jnp.transpose(char_embeddings))
+      char_embeddings = self.text_char_emb.embedding
+      char_embeddings = nn.Dropout(rate=self.dropout_rate)(
+          char_embeddings, deterministic=not is_training)
+      logits_mask = jnp.matmul(x_mask, jnp.transpose(char_embeddings))
 
     # Next sentence prediction
-    if self.use_output_mlp:
-      logits_nsp = common_layers.MlpBlock(
-          out_dim=2,
-          mlp_dim=self.emb_dim,
-          dtype=dtype,
-          out_dropout=False,
-          dropout_rate=self.dropout_rate,
-          deterministic=not is_training,
-          activation_fn=self.activation_fn)(
-              x)
-    else:
-      logits_nsp = nn.Dense(2)(x)
+    logits_nsp = None
+    if 'nsp' in outputs:
+      logits_nsp = output_head(1, 2, x)
 
-    # Average over temporal dimension
-    if self.region_date_pooling == 'average':
-      x = jnp.multiply(padding_mask.astype(jnp.float32), x)
-      x = jnp.sum(x, 1) / text_len.astype(jnp.float32)[..., None]
-    elif self.region_date_pooling == 'sum':
-      x = jnp.multiply(padding_mask.astype(jnp.float32), x)
-      x = jnp.sum(x, 1)
-    elif self.region_date_pooling == 'first':
-      x = x[:, 0, :]
-    else:
-      raise ValueError('Wrong pooling type specified.')
+    pred_date = None
+    logits_subregion = None
+    if 'date' in outputs or 'subregion' in outputs:
+      # Average over temporal dimension
+      if segment_starts is not None:
+        x = self._pool_segments(x, padding, inputs_segmentation,
+                                segment_starts)
+      elif self.region_date_pooling == 'average':
+        x = jnp.multiply(padding_mask.astype(jnp.float32), x)
+        x = jnp.sum(x, 1) / text_len.astype(jnp.float32)[..., None]
+      elif self.region_date_pooling == 'sum':
+        x = jnp.multiply(padding_mask.astype(jnp.float32), x)
+        x = jnp.sum(x, 1)
+      elif self.region_date_pooling == 'first':
+        x = x[:, 0, :]
+      else:
+        raise ValueError('Wrong pooling type specified.')
 
     # Date pred
-    if self.output_date_dist:
-      output_date_dim = self.output_date
-    else:
-      output_date_dim = 1
-
-    if self.use_output_mlp:
-      pred_date = common_layers.MlpBlock(
-          out_dim=output_date_dim,
-          mlp_dim=self.emb_dim,
-          dtype=dtype,
-          out_dropout=False,
-          dropout_rate=self.dropout_rate,
-          deterministic=not is_training,
-          activation_fn=self.activation_fn)(
-              x)
-    else:
-      pred_date = nn.Dense(output_date_dim)(x)
+    if 'date' in outputs:
+      if self.output_date_dist:
+        output_date_dim = self.output_date
+      else:
+        output_date_dim = 1
+      pred_date = output_head(2, output_date_dim, x)
 
     # Region logits
-    if self.use_output_mlp:
-      logits_subregion = common_layers.MlpBlock(
-          out_dim=self.output_subregions,
-          mlp_dim=self.emb_dim,
-          dtype=dtype,
-          out_dropout=False,
-          dropout_rate=self.dropout_rate,
-          deterministic=not is_training,
-          activation_fn=self.activation_fn)(
-              x)
-    else:
-      logits_subregion = nn.Dense(self.output_subregions)(x)
+    if 'subregion' in outputs:
+      logits_subregion = output_head(3, self.output_subregions, x)
 
     outputs = (pred_date, logits_subregion, logits_mask, logits_nsp)
     if self.output_return_emb:
       return outputs, torso_output
     else:
       return outputs
+
+  def _pool_segments(self, x, padding, inputs_segmentation, segment_starts):
+    """Pools the torso output of each packed text; [b, segments, emb]."""
+    if self.region_date_pooling == 'first':
+      return jnp.take_along_axis(x, segment_starts[..., None], axis=1)
+
+    start_segment = jnp.take_along_axis(inputs_segmentation, segment_starts, 1)
+    in_segment = jnp.logical_and(
+        inputs_segmentation[:, None, :] == start_segment[:, :, None],
+        padding[:, None, :] > 0).astype(jnp.float32)  # [b, segments, l]
+    pooled = jnp.einsum('BSL,BLD->BSD', in_segment, x.astype(jnp.float32))
+    if self.region_date_pooling == 'average':
+      pooled = pooled / jnp.sum(in_segment, -1, keepdims=True)
+    elif self.region_date_pooling != 'sum':
+      raise ValueError('Wrong pooling type specified.')
+    return pooled.astype(x.dtype)
@@ -13,7 +13,12 @@
 # limitations under the License.
 """Alphabet classes."""
 
+import collections
+import itertools
+import multiprocessing
+import os
 import re
+from typing import Iterable, Iterator, List, Optional
 
 import numpy as np
 
@@ -109,63 +114,99 @@ class GreekAlphabet(Alphabet):
         u'\u03CE': u'\u1F7D'  # small letter omega
     }
     self.oxia_to_tonos = {v: k for k, v in self.tonos_to_oxia.items()}
+    self._normalizer = _GreekNormalizer(self.oxia_to_tonos)
 
   def filter(self, t):  # override previous filter function
-    # lowercase
-    t = t.lower()
-
-    # replace dot below
-    t = t.replace(u'\u0323', '')
-
-    # replace perispomeni
-    t = t.replace(u'\u0342', '')
-    t = t.replace(u'\u02C9', '')
-
-    # replace ending sigma
-    t = re.sub(r'([\w\[\]])σ(?![\[\]])(\b)', r'\1ς\2', t)
-
-    # replace oxia with tonos
-    for oxia, tonos in self.oxia_to_tonos.items():
-      t = t.replace(oxia, tonos)
-
-    # replace h
-    h_patterns = {
-        # input: #target
-        'ε': 'ἑ',
-        'ὲ': 'ἓ',
-        'έ': 'ἕ',
-        'α': 'ἁ',
-        'ὰ': 'ἃ',
-        'ά': 'ἅ',
-        'ᾶ': 'ἇ',
-        'ι': 'ἱ',
-        'ὶ': 'ἳ',
-        'ί': 'ἵ',
-        'ῖ': 'ἷ',
-        'ο': 'ὁ',
-        'ό': 'ὅ',
-        'ὸ': 'ὃ',
-        'υ': 'ὑ',
-        'ὺ': 'ὓ',
-        'ύ': 'ὕ',
-        'ῦ': 'ὗ',
-        'ὴ': 'ἣ',
-        'η': 'ἡ',
-        'ή': 'ἥ',
-        'ῆ': 'ἧ',
-        'ὼ': 'ὣ',
-        'ώ': 'ὥ',
-        'ω': 'ὡ',
-        'ῶ': 'ὧ'
-    }
-
-    # iterate by keys
-    for h_in, h_tar in h_patterns.items():
-      # look up and replace h[ and h]
-      t = re.sub(r'ℎ(\[?){}'.format(h_in), r'\1{}'.format(h_tar), t)
-      t = re.sub(r'ℎ(\]?){}'.format(h_in), r'{}\1'.format(h_tar), t)
-
-    # any h left is an ἡ
-    t = re.sub(r'(\[?)ℎ(\]?)', r'\1ἡ\2', t)
-
+    return self._normalizer(t)
+
+  def filter_many(self,
+                  texts: Iterable[str],
+                  processes: Optional[int] = None,
+                  chunksize: int = 1000) -> Iterator[str]:
+    """Yields `filter(t)` for every text, in order, using a process pool.
+
+    Texts are read from the iterable and filtered `chunksize` at a time, with
+    at most two chunks per process in flight, so a corpus can be streamed
+    through without holding it in memory.
+    """
+    processes = processes or os.cpu_count() or 1
+    texts = iter(texts)
+    pending = collections.deque()
+    with multiprocessing.Pool(processes) as pool:
+      while True:
+        chunk = list(itertools.islice(texts, chunksize))
+        if chunk:
+          pending.append(
+              pool.apply_async(self._normalizer.filter_chunk, (chunk,)))
+        if pending and (not chunk or len(pending) >= 2 * processes):
+          yield from pending.popleft().get()
+        elif not chunk:
+          return
+
+
+class _GreekNormalizer:
+  """Compiled rules of `GreekAlphabet.filter`, applied in a few passes."""
+
+  # Aspirated forms of vowels written with a preceding h (ℎ).
+  h_patterns = {
+      # input: #target
+      'ε': 'ἑ',
+      'ὲ': 'ἓ',
+      'έ': 'ἕ',
+      'α': 'ἁ',
+      'ὰ': 'ἃ',
+      'ά': 'ἅ',
+      'ᾶ': 'ἇ',
+      'ι': 'ἱ',
+      'ὶ': 'ἳ',
+      'ί': 'ἵ',
+      'ῖ': 'ἷ',
+      'ο': 'ὁ',
+      'ό': 'ὅ',
+      'ὸ': 'ὃ',
+      'υ': 'ὑ',
+      'ὺ': 'ὓ',
+      'ύ': 'ὕ',
+      'ῦ': 'ὗ',
+      'ὴ': 'ἣ',
+      'η': 'ἡ',
+      'ή': 'ἥ',
+      'ῆ': 'ἧ',
+      'ὼ': 'ὣ',
+      'ώ': 'ὥ',
+      'ω': 'ὡ',
+      'ῶ': 'ὧ'
+  }
+
+  def __init__(self, oxia_to_tonos):
+    # Remove dot below and perispomeni, and replace oxia with tonos. These
+    # only map letters to letters, so they can be applied before the final
+    # sigma rule, which only depends on what is a word character.
+    table = {u'\u0323': None, u'\u0342': None, u'\u02C9': None}
+    table.update(oxia_to_tonos)
+    self.table = str.maketrans(table)
+
+    self.final_sigma = re.compile(r'([\w\[\]])σ(?![\[\]])(\b)')
+
+    # h[ and h] followed by a vowel become the aspirated vowel with the
+    # bracket moved out of the way; any other h is an ἡ.
+    self.h = re.compile(r'ℎ(?:([\[\]]?)([{}]))?'.format(''.join(
+        self.h_patterns)))
+
+  def _replace_h(self, m):
+    bracket, vowel = m.groups()
+    if vowel is None:
+      return 'ἡ'
+    if bracket == ']':
+      return self.h_patterns[vowel] + bracket
+    return bracket + self.h_patterns[vowel]
+
+  def __call__(self, t):
+    t = t.lower().translate(self.table)
+    t = self.final_sigma.sub(r'\1ς\2', t)
+    if 'ℎ' in t:
+      t = self.h.sub(self._replace_h, t)
     return t
+
+  def filter_chunk(self, ts: List[str]) -> List[str]:
+    return [self(t) for t in ts]
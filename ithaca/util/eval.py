@@ -13,14 +13,14 @@
 # limitations under the License.
 """Eval utils."""
 
-from typing import List, NamedTuple
+from typing import List, NamedTuple, Tuple
 
 import jax
 import jax.numpy as jnp
 import numpy as np
 from .text import idx_to_text
-from .text import text_to_idx
-from .text import text_to_word_idx
+from .text import idx_to_text_batch
+from .text import TokenState
 import tqdm
 
 
@@ -34,11 +34,11 @@ def date_loss_l1(pred, target_min, target_max):
   return loss
 
 
-def grad_to_saliency_char(gradient_char, text_char_onehot, text_len, alphabet):
-  """Generates saliency map."""
+def grad_to_saliency_char(gradient_char, text_char, text_len, alphabet):
+  """Generates saliency map from the gradient and the character indices."""
   saliency_char = np.linalg.norm(gradient_char, axis=2)[0, :text_len[0]]
 
-  text_char = np.array(text_char_onehot).argmax(axis=-1)
+  text_char = np.asarray(text_char)
   idx_mask = np.logical_or(
       text_char[0, :text_len[0]] > alphabet.alphabet_end_idx,
       text_char[0, :text_len[0]] < alphabet.alphabet_start_idx)
@@ -54,10 +54,10 @@ def grad_to_saliency_char(gradient_char, text_char_onehot, text_len, alphabet):
   return saliency_char_tmp
 
 
-def grad_to_saliency_word(gradient_word, text_word_onehot, text_len, alphabet):
-  """Generates saliency map."""
+def grad_to_saliency_word(gradient_word, text_word, text_len, alphabet):
+  """Generates saliency map from the gradient and the word indices."""
   saliency_word = np.linalg.norm(gradient_word, axis=2)[0, :text_len[0]]
-  text_word = np.array(text_word_onehot).argmax(axis=-1)
+  text_word = np.asarray(text_word)
 
   saliency_word = saliency_word.copy()
   start_idx = None
@@ -114,6 +114,19 @@ class BeamEntry(NamedTuple):
   pred_logprob: float
 
 
+class ParallelFillStats(NamedTuple):
+  """Decoding steps of a restoration with parallel filling."""
+
+  num_missing: int
+  steps: int  # sequential forward passes
+  parallel: int  # characters committed for their confidence
+
+  @property
+  def steps_saved(self) -> int:
+    """Steps saved relative to restoring one character per step."""
+    return self.num_missing - self.steps
+
+
 def beam_search_batch_2d(forward,
                          alphabet,
                          text_pred,
@@ -124,117 +137,198 @@ def beam_search_batch_2d(forward,
                          nucleus=False,
                          nucleus_top_p=0.8,
                          display_progress=False) -> List[BeamEntry]:
-  """Non-sequential beam search."""
-
-  beam = [BeamEntry(text_pred, mask_idx, 0, 0.)]
-  beam_top = {}
-
-  text_len = len(text_pred.rstrip(alphabet.pad))
+  """Non-sequential beam search.
+
+  Hypotheses are kept as arrays of character indices. Every step scores all
+  (hypothesis, missing position, valid character) candidates at once, merges
+  candidates that lead to the same restoration (keyed by the bytes of their
+  restored characters), and keeps the `beam_width` best. Strings are only
+  built for the returned entries.
+  """
+  beam, _ = _beam_search_2d(forward, alphabet, text_pred, mask_idx, rng,
+                            beam_width, temperature, nucleus, nucleus_top_p,
+                            display_progress)
+  return beam
+
+
+def beam_search_parallel_fill(
+    forward,
+    alphabet,
+    text_pred,
+    mask_idx,
+    fill_threshold,
+    rng=None,
+    beam_width=20,
+    temperature=1.) -> Tuple[List[BeamEntry], ParallelFillStats]:
+  """`beam_search_batch_2d` that fills confident characters in parallel.
+
+  In the style of mask-predict, at every step each hypothesis also commits
+  all of its missing positions whose most probable character has at least
+  probability `fill_threshold`, so only the low-confidence positions are
+  decoded one step at a time. Results are approximate, see
+  `inference.parallel_fill_divergence`.
+
+  Returns:
+    The restorations, and how many steps were needed.
+  """
+  return _beam_search_2d(forward, alphabet, text_pred, mask_idx, rng,
+                         beam_width, temperature, False, None, False,
+                         fill_threshold)
+
+
+def _beam_search_2d(forward,
+                    alphabet,
+                    text_pred,
+                    mask_idx,
+                    rng,
+                    beam_width,
+                    temperature,
+                    nucleus,
+                    nucleus_top_p,
+                    display_progress,
+                    fill_threshold=None):
+  """Implements beam_search_batch_2d and beam_search_parallel_fill."""
+  mask_idx = list(mask_idx)
+  if not mask_idx:
+    return [], ParallelFillStats(0, 0, 0)
+  mask_pos = np.array(mask_idx)
+  num_missing = len(mask_idx)
+
+  # Characters a missing position may be restored to.
+  valid_chars = np.array(
+      [alphabet.char2idx[alphabet.space]] +
+      list(range(alphabet.alphabet_start_idx,
+                 alphabet.char2idx[alphabet.punctuation[-1]] + 1)))
+  num_chars = len(valid_chars)
+
+  # Beam state: character and word indices, which missing positions are still
+  # to be restored, and the accumulated log-probability of each hypothesis.
+  beam_tokens = [TokenState.from_text(text_pred, alphabet)]
+  beam_chars = beam_tokens[0].text_char.reshape(1, -1)
+  beam_remaining = np.ones((1, num_missing), dtype=bool)
+  beam_logprob = np.zeros((1,), dtype=np.float64)
+
+  # Complete hypotheses; with parallel filling they finish at different steps.
+  done_chars, done_logprob = [], []
+  steps = parallel = 0
 
   # Initialise tqdm bar
   if display_progress:
-    pbar = tqdm.tqdm(total=len(mask_idx))
-
-  while beam:
-    beam_tmp = []
-    beam_batch = []
+    pbar = tqdm.tqdm(total=num_missing)
 
-    text_chars = []
-    text_words = []
-
-    for text_pred, mask_idx, pred_len, pred_logprob in beam:
-
-      mask_idx = mask_idx.copy()  # pytype: disable=attribute-error  # strict_namedtuple_checks
-      text_char = text_to_idx(text_pred, alphabet).reshape(1, -1)
-      text_word = text_to_word_idx(text_pred, alphabet).reshape(1, -1)
-      text_chars.append(text_char)
-      text_words.append(text_word)
-      beam_batch.append(BeamEntry(text_pred, mask_idx, pred_len, pred_logprob))
-    text_chars = np.vstack(text_chars)
-    text_words = np.vstack(text_words)
+  while beam_tokens:
+    text_words = np.vstack([tokens.text_word for tokens in beam_tokens])
 
     _, _, mask_logits, _ = forward(
-        text_char=text_chars,
+        text_char=beam_chars,
         text_word=text_words,
         text_char_onehot=None,
         text_word_onehot=None,
+        mask_positions=np.broadcast_to(mask_pos,
+                                       (len(beam_tokens), num_missing)),
+        outputs=('mask',),
         rngs={'dropout': rng},
         is_training=False)
+    steps += 1
     mask_logits = mask_logits / temperature
-    mask_logits = np.array(mask_logits)
-
-    for batch_i in range(mask_logits.shape[0]):
-      text_pred, mask_idx, pred_len, pred_logprob = beam_batch[batch_i]
-      mask_logprob = log_softmax(mask_logits)[batch_i, :text_len]
-      mask_pred = softmax(mask_logits)[batch_i, :text_len]
-      mask_pred_argmax = np.dstack(
-          np.unravel_index(np.argsort(-mask_pred.ravel()), mask_pred.shape))[0]
-
-      # Keep only predictions for mask
-      for i in range(mask_pred_argmax.shape[0]):
-        if (mask_pred_argmax[i][0] in mask_idx and  # pytype: disable=unsupported-operands  # strict_namedtuple_checks
-            (mask_pred_argmax[i][1] == alphabet.char2idx[alphabet.space] or
-             (mask_pred_argmax[i][1] >= alphabet.alphabet_start_idx and
-              mask_pred_argmax[i][1] <=
-              alphabet.char2idx[alphabet.punctuation[-1]]))):
-          text_char_i = text_chars.copy()
-          text_char_i[batch_i, mask_pred_argmax[i][0]] = mask_pred_argmax[i][1]
-          text_pred_i = idx_to_text(
-              text_char_i[batch_i], alphabet, strip_sos=False, strip_pad=False)
-
-          mask_idx_i = mask_idx.copy()  # pytype: disable=attribute-error  # strict_namedtuple_checks
-          mask_idx_i.remove(mask_pred_argmax[i][0])
-
-          if nucleus:
-            mask_logits_i = mask_logits[batch_i, mask_pred_argmax[i][0]]
-            mask_logits_i = nucleus_sample_inner(mask_logits_i, nucleus_top_p)
-            mask_logprob_i = log_softmax(mask_logits_i)
-
-            # Skip expanding the beam if logprob too small
-            if mask_logits_i[mask_pred_argmax[i][1]] < -1e12:
-              continue
-
-            pred_logprob_i = pred_logprob + mask_logprob_i[mask_pred_argmax[i]
-                                                           [1]]
-          else:
-            pred_logprob_i = pred_logprob + mask_logprob[mask_pred_argmax[i][0],
-                                                         mask_pred_argmax[i][1]]
-
-          if not mask_idx_i:
-            if (text_pred_i
-                not in beam_top) or (text_pred_i in beam_top and
-                                     beam_top[text_pred_i][3] > pred_logprob_i):
-              beam_top[text_pred_i] = BeamEntry(text_pred_i, mask_idx_i,
-                                                pred_len + 1, pred_logprob_i)
-          else:
-            beam_tmp.append(
-                BeamEntry(text_pred_i, mask_idx_i, pred_len + 1,
-                          pred_logprob_i))
-
-    # order all candidates by score
-    beam_tmp_kv = {}
-    for text_pred, mask_idx, pred_len, pred_logprob in beam_tmp:
-      if (text_pred not in beam_tmp_kv) or (
-          text_pred in beam_tmp_kv and
-          beam_tmp_kv[text_pred].pred_logprob > pred_logprob):
-        beam_tmp_kv[text_pred] = BeamEntry(text_pred, mask_idx, pred_len,
-                                           pred_logprob)
-    beam_tmp = sorted(
-        beam_tmp_kv.values(),
-        key=lambda entry: entry.pred_logprob,
-        reverse=True)
+    mask_logits = np.array(mask_logits)  # [beam, missing, vocab]
+
+    # Score all candidates: [beam, missing, valid chars]
+    if nucleus:
+      mask_logits = np.stack([
+          nucleus_sample_inner(logits.copy(), nucleus_top_p)
+          for logits in mask_logits.reshape(-1, mask_logits.shape[-1])
+      ]).reshape(mask_logits.shape)
+      # Skip expanding the beam if logprob too small
+      keep = mask_logits[:, :, valid_chars] >= -1e12
+    else:
+      keep = np.ones(mask_logits.shape[:2] + (num_chars,), dtype=bool)
+    mask_logprob = log_softmax(mask_logits)[:, :, valid_chars]
+
+    if fill_threshold is not None:
+      # Commit the confident positions of every hypothesis; the others are
+      # expanded from the same logits below.
+      best_char = mask_logprob.argmax(axis=-1)
+      best_logprob = mask_logprob.max(axis=-1)
+      confident = beam_remaining & (best_logprob >= np.log(fill_threshold))
+      for b, j in zip(*np.nonzero(confident)):
+        beam_tokens[b].fill_(mask_pos[j], valid_chars[best_char[b, j]])
+      beam_logprob = beam_logprob + np.where(confident, best_logprob, 0).sum(1)
+      beam_remaining = beam_remaining & ~confident
+      beam_chars = np.vstack([tokens.text_char for tokens in beam_tokens])
+      parallel += int(confident.sum())
+
+      complete = ~beam_remaining.any(axis=1)
+      done_chars.extend(beam_chars[complete])
+      done_logprob.extend(beam_logprob[complete])
+
+    cand_logprob = beam_logprob[:, None, None] + mask_logprob
+    keep &= beam_remaining[:, :, None]
+    cand_beam, cand_missing, cand_char = np.nonzero(keep)
+    cand_logprob = cand_logprob[cand_beam, cand_missing, cand_char]
+
+    # Restored characters of each candidate, used to merge duplicates.
+    cand_restored = beam_chars[cand_beam][:, mask_pos]
+    cand_restored[np.arange(len(cand_beam)),
+                  cand_missing] = valid_chars[cand_char]
+    cand_keys = np.ascontiguousarray(cand_restored).view(
+        np.dtype((np.void, cand_restored.dtype.itemsize * num_missing)))[:, 0]
+
+    # For duplicates keep the lowest scoring candidate, then order by score.
+    order = np.lexsort((cand_logprob, cand_keys))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = cand_keys[order[1:]] != cand_keys[order[:-1]]
+    unique = order[first]
+    unique = unique[np.argsort(-cand_logprob[unique], kind='stable')]
 
     # select k best
-    beam = beam_tmp[:beam_width]
+    best = unique[:beam_width]
+    beam_tokens = [
+        beam_tokens[cand_beam[i]].fill(mask_pos[cand_missing[i]],
+                                       valid_chars[cand_char[i]]) for i in best
+    ]
+    beam_remaining = beam_remaining[cand_beam[best]]
+    beam_remaining[np.arange(len(best)), cand_missing[best]] = False
+    beam_logprob = cand_logprob[best]
+
+    complete = ~beam_remaining.any(axis=1)
+    if beam_tokens:
+      beam_chars = np.vstack([tokens.text_char for tokens in beam_tokens])
+      done_chars.extend(beam_chars[complete])
+      done_logprob.extend(beam_logprob[complete])
+    beam_tokens = [t for t, c in zip(beam_tokens, complete) if not c]
+    if beam_tokens:
+      beam_chars = beam_chars[~complete]
+      beam_remaining = beam_remaining[~complete]
+      beam_logprob = beam_logprob[~complete]
 
     # update progress bar
     if display_progress:
       pbar.update(1)
 
-  # order all candidates by score
-  return sorted(
-      beam_top.values(), key=lambda entry: entry.pred_logprob,
-      reverse=True)[:beam_width]
+  stats = ParallelFillStats(num_missing, steps, parallel)
+  if not done_chars:
+    return [], stats
+
+  # Hypotheses of different steps may restore the same text; as above, keep
+  # the lowest scoring of each and order by score.
+  done_chars = np.array(done_chars)
+  done_logprob = np.array(done_logprob)
+  done_keys = np.ascontiguousarray(done_chars[:, mask_pos]).view(
+      np.dtype((np.void, done_chars.dtype.itemsize * num_missing)))[:, 0]
+  order = np.lexsort((done_logprob, done_keys))
+  first = np.ones(len(order), dtype=bool)
+  first[1:] = done_keys[order[1:]] != done_keys[order[:-1]]
+  unique = order[first]
+  best = unique[np.argsort(-done_logprob[unique], kind='stable')][:beam_width]
+
+  beam_texts = idx_to_text_batch(
+      done_chars[best], alphabet, strip_sos=False, strip_pad=False)
+  beam = [
+      BeamEntry(text, [], num_missing, logprob)
+      for text, logprob in zip(beam_texts, done_logprob[best])
+  ]
+  return beam, stats
 
 
 def beam_search_batch_1d(forward,
@@ -251,6 +345,7 @@ def beam_search_batch_1d(forward,
 
   beam = [BeamEntry(text_pred, mask_idx, 0, 0.)]
   beam_top = {}
+  beam_tokens = {text_pred: TokenState.from_text(text_pred, alphabet)}
 
   # Initialise tqdm bar
   if display_progress:
@@ -266,10 +361,8 @@ def beam_search_batch_1d(forward,
     for text_pred, mask_idx, pred_len, pred_logprob in beam:
 
       mask_idx = mask_idx.copy()  # pytype: disable=attribute-error  # strict_namedtuple_checks
-      text_char = text_to_idx(text_pred, alphabet).reshape(1, -1)
-      text_word = text_to_word_idx(text_pred, alphabet).reshape(1, -1)
-      text_chars.append(text_char)
-      text_words.append(text_word)
+      text_chars.append(beam_tokens[text_pred].text_char.reshape(1, -1))
+      text_words.append(beam_tokens[text_pred].text_word.reshape(1, -1))
       beam_batch.append(BeamEntry(text_pred, mask_idx, pred_len, pred_logprob))
     text_chars = np.vstack(text_chars)
     text_words = np.vstack(text_words)
@@ -279,15 +372,21 @@ def beam_search_batch_1d(forward,
         text_word=text_words,
         text_char_onehot=None,
         text_word_onehot=None,
+        mask_positions=np.array([[entry.mask_idx[0]] for entry in beam_batch]),
+        outputs=('mask',),
         rngs={'dropout': rng},
         is_training=False)
     mask_logits = mask_logits / temperature
     mask_logits = np.array(mask_logits)
 
+    # (parent text, position, char) of every candidate, to update its tokens
+    # once it is selected.
+    beam_tmp_parents = {}
+
     for batch_i in range(mask_logits.shape[0]):
       text_pred, mask_idx, pred_len, pred_logprob = beam_batch[batch_i]
 
-      mask_logits_i = mask_logits[batch_i, mask_idx[0]]  # pytype: disable=unsupported-operands  # strict_namedtuple_checks
+      mask_logits_i = mask_logits[batch_i, 0]
       if nucleus:
         mask_logits_i = nucleus_sample_inner(mask_logits_i, nucleus_top_p)
 
@@ -322,6 +421,7 @@ def beam_search_batch_1d(forward,
         else:
           beam_tmp.append(
               BeamEntry(text_pred_i, mask_idx_i, pred_len + 1, pred_logprob_i))
+          beam_tmp_parents[text_pred_i] = (text_pred, mask_idx[0], char_i)  # pytype: disable=unsupported-operands  # strict_namedtuple_checks
 
     # order all candidates by score
     beam_tmp_kv = {}
@@ -338,6 +438,11 @@ def beam_search_batch_1d(forward,
 
     # select k best
     beam = beam_tmp[:beam_width]
+    beam_tokens = {
+        entry.text_pred:
+        beam_tokens[beam_tmp_parents[entry.text_pred][0]].fill(
+            *beam_tmp_parents[entry.text_pred][1:]) for entry in beam
+    }
 
     # update progress bar
     if display_progress:
@@ -361,6 +466,7 @@ def saliency_loss_subregion(forward,
       text_char_emb=text_char_emb,
       text_word_emb=text_word_emb,
       padding=padding,
+      outputs=('subregion',),
       rngs={'dropout': rng},
       is_training=False)
   if subregion is None:
@@ -375,6 +481,7 @@ def saliency_loss_date(forward, text_char_emb, text_word_emb, padding, rng):
       text_char_emb=text_char_emb,
       text_word_emb=text_word_emb,
       padding=padding,
+      outputs=('date',),
       rngs={'dropout': rng},
       is_training=False)
 
@@ -397,6 +504,118 @@ def predicted_dates(date_pred_probs, date_min, date_max, date_interval):
   return date_pred_argmax, date_pred_avg
 
 
+def saliency_outputs_attribution(forward,
+                                 text_char_emb,
+                                 text_word_emb,
+                                 padding,
+                                 rng,
+                                 subregion=None,
+                                 weights=None,
+                                 **model_kwargs):
+  """Predicted date and subregion logits, for `jax.vjp` with `has_aux`.
+
+  Returns the logits of the predicted date and subregion, stacked and summed
+  over the batch (texts do not interact, so the gradient of each text only
+  depends on its own logits), and the full date and subregion logits.
+
+  For packed inputs (see `Model.__call__`) the logits of every segment are
+  summed, each scaled by `weights` ([batch, segments]) if given, e.g. to
+  ignore unused segments.
+  """
+
+  date_pred, subregion_logits, _, _ = forward(
+      text_char_emb=text_char_emb,
+      text_word_emb=text_word_emb,
+      padding=padding,
+      outputs=('date', 'subregion'),
+      rngs={'dropout': rng},
+      is_training=False,
+      **model_kwargs)
+  date_flat = date_pred.reshape(-1, date_pred.shape[-1])
+  subregion_flat = subregion_logits.reshape(-1, subregion_logits.shape[-1])
+  rows = jnp.arange(date_flat.shape[0])
+  if subregion is None:
+    subregion = subregion_flat.argmax(axis=-1)
+  outputs = jnp.stack([
+      date_flat[rows, date_flat.argmax(axis=-1)],
+      subregion_flat[rows, subregion]
+  ])
+  if weights is not None:
+    outputs = outputs * weights.reshape(-1)
+  return outputs.sum(axis=1), (date_pred, subregion_logits)
+
+
+def embed(params, text_char, text_word):
+  """Looks up the character and word embeddings that saliency is taken of."""
+  text_char_emb = jnp.take(
+      params['params']['char_embeddings']['embedding'], text_char, axis=0)
+  text_word_emb = jnp.take(
+      params['params']['word_embeddings']['embedding'], text_word, axis=0)
+  return text_char_emb, text_word_emb
+
+
+def compute_attribution_logits_and_saliency_maps(text_char,
+                                                 text_word,
+                                                 text_len,
+                                                 padding,
+                                                 forward,
+                                                 params,
+                                                 rng,
+                                                 alphabet,
+                                                 vocab_char_size,
+                                                 vocab_word_size,
+                                                 subregion_loss_kwargs=None):
+  """Compute date and subregion logits and their saliency maps.
+
+  The model is run forward once, and the date and subregion gradients are
+  obtained together from one backward pass with stacked cotangents. The inputs
+  may hold a batch of texts, with `text_len` giving the length of each.
+
+  Returns:
+    date logits [batch, dates], subregion logits [batch, subregions], and lists
+    with the date and the subregion saliency map of every text.
+  """
+
+  del vocab_char_size, vocab_word_size  # Unused, embeddings are gathered.
+  if subregion_loss_kwargs is None:
+    subregion_loss_kwargs = {}
+
+  text_char_emb, text_word_emb = embed(params, text_char, text_word)
+
+  # Get saliency gradients
+  _, saliency_vjp, (date_logits, subregion_logits) = jax.vjp(
+      lambda char_emb, word_emb: saliency_outputs_attribution(  # pylint: disable=g-long-lambda
+          forward, char_emb, word_emb, padding, rng, **subregion_loss_kwargs),
+      text_char_emb,
+      text_word_emb,
+      has_aux=True)
+  gradient_char, gradient_word = jax.vmap(saliency_vjp)(
+      jnp.eye(2, dtype=date_logits.dtype))
+
+  # grad x input, for dates ([0]) and subregions ([1])
+  input_grad_char = np.multiply(gradient_char, text_char_emb[None])
+  input_grad_word = np.multiply(gradient_word, text_word_emb[None])
+
+  date_saliency = []
+  subregion_saliency = []
+  for i in range(text_char.shape[0]):
+    for saliency, output in ((date_saliency, 0), (subregion_saliency, 1)):
+      grad_char = grad_to_saliency_char(
+          input_grad_char[output, i:i + 1],
+          text_char[i:i + 1],
+          text_len=text_len[i:i + 1],
+          alphabet=alphabet)
+      grad_word = grad_to_saliency_word(
+          input_grad_word[output, i:i + 1],
+          text_word[i:i + 1],
+          text_len=text_len[i:i + 1],
+          alphabet=alphabet)
+      saliency.append(np.clip(grad_char + grad_word, 0, 1))
+
+  return (np.array(date_logits), np.array(subregion_logits), date_saliency,
+          subregion_saliency)
+
+
 def compute_attribution_saliency_maps(text_char,
                                       text_word,
                                       text_len,
@@ -410,77 +629,35 @@ def compute_attribution_saliency_maps(text_char,
                                       subregion_loss_kwargs=None):
   """Compute saliency maps for subregions and dates."""
 
-  if subregion_loss_kwargs is None:
-    subregion_loss_kwargs = {}
-
-  # Get saliency gradients
-  dtype = params['params']['char_embeddings']['embedding'].dtype
-  text_char_onehot = jax.nn.one_hot(text_char, vocab_char_size).astype(dtype)
-  text_word_onehot = jax.nn.one_hot(text_word, vocab_word_size).astype(dtype)
-  text_char_emb = jnp.matmul(text_char_onehot,
-                             params['params']['char_embeddings']['embedding'])
-  text_word_emb = jnp.matmul(text_word_onehot,
-                             params['params']['word_embeddings']['embedding'])
-  gradient_subregion_char, gradient_subregion_word = jax.grad(
-      saliency_loss_subregion, (1, 2))(
-          forward,
-          text_char_emb,
-          text_word_emb,
-          padding,
-          rng=rng,
-          **subregion_loss_kwargs)
-  gradient_date_char, gradient_date_word = jax.grad(saliency_loss_date, (1, 2))(
-      forward, text_char_emb, text_word_emb, padding=padding, rng=rng)
-
-  # Generate saliency maps for subregions
-  input_grad_subregion_char = np.multiply(gradient_subregion_char,
-                                          text_char_emb)  # grad x input
-  input_grad_subregion_word = np.multiply(gradient_subregion_word,
-                                          text_word_emb)
-  grad_char = grad_to_saliency_char(
-      input_grad_subregion_char,
-      text_char_onehot,
-      text_len=text_len,
-      alphabet=alphabet)
-  grad_word = grad_to_saliency_word(
-      input_grad_subregion_word,
-      text_word_onehot,
-      text_len=text_len,
-      alphabet=alphabet)
-  subregion_saliency = np.clip(grad_char + grad_word, 0, 1)
-
-  # Generate saliency maps for dates
-  input_grad_date_char = np.multiply(gradient_date_char,
-                                     text_char_emb)  # grad x input
-  input_grad_date_word = np.multiply(gradient_date_word, text_word_emb)
-  grad_char = grad_to_saliency_char(
-      input_grad_date_char,
-      text_char_onehot,
-      text_len=text_len,
-      alphabet=alphabet)
-  grad_word = grad_to_saliency_word(
-      input_grad_date_word,
-      text_word_onehot,
-      text_len=text_len,
-      alphabet=alphabet)
-  date_saliency = np.clip(grad_char + grad_word, 0, 1)
-
-  return date_saliency, subregion_saliency
+  _, _, date_saliency, subregion_saliency = (
+      compute_attribution_logits_and_saliency_maps(
+          text_char, text_word, text_len, padding, forward, params, rng,
+          alphabet, vocab_char_size, vocab_word_size, subregion_loss_kwargs))
+  return date_saliency[0], subregion_saliency[0]
 
 
 def saliency_loss_mask(forward, text_char_emb, text_word_emb, padding, rng,
                        char_pos, char_idx):
-  """Saliency map for mask."""
+  """Saliency map for mask.
+
+  `char_pos` and `char_idx` may also hold one position and character per text
+  of a batch, in which case the (independent) logits of all texts are summed.
+  """
 
+  batch_size = text_char_emb.shape[0]
   _, _, mask_logits, _ = forward(
       text_char_emb=text_char_emb,
       text_word_emb=text_word_emb,
       text_char_onehot=None,
       text_word_onehot=None,
       padding=padding,
+      mask_positions=jnp.broadcast_to(
+          jnp.reshape(char_pos, (-1, 1)), (batch_size, 1)),
+      outputs=('mask',),
       rngs={'dropout': rng},
       is_training=False)
-  return mask_logits[0, char_pos, char_idx]
+  rows = jnp.arange(batch_size)
+  return mask_logits[rows, 0, char_idx].sum()
 
 
 class SequentialRestorationSaliencyResult(NamedTuple):
@@ -489,74 +666,175 @@ class SequentialRestorationSaliencyResult(NamedTuple):
   saliency_map: np.ndarray  # saliency map for the newly added character
 
 
+def _greedy_restoration_step(forward,
+                             tokens,
+                             text_len,
+                             mask_idx,
+                             rng,
+                             fill_threshold=None):
+  """Returns the most probable (position, character) still to be restored.
+
+  With `fill_threshold`, returns a list of the (position, character) pairs of
+  the most probable prediction and of all positions whose prediction has at
+  least that probability, most probable first.
+  """
+  # Only the characters that are to be restored are scored.
+  mask_pos = np.array(sorted(i for i in mask_idx if i < text_len))
+  _, _, mask_logits, _ = forward(
+      text_char=tokens.text_char.reshape(1, -1),
+      text_word=tokens.text_word.reshape(1, -1),
+      text_char_onehot=None,
+      text_word_onehot=None,
+      mask_positions=mask_pos.reshape(1, -1),
+      outputs=('mask',),
+      rngs={'dropout': rng},
+      is_training=False)
+  mask_pred = jax.nn.softmax(mask_logits)[0]
+
+  # Greedily, non-sequentially take the next highest probability prediction
+  # out of the characters that are to be restored
+  pred_i, pred_char_idx = np.unravel_index(
+      np.argmax(mask_pred), mask_pred.shape)
+  if fill_threshold is None:
+    return mask_pos[pred_i], pred_char_idx
+
+  mask_pred = np.asarray(mask_pred)
+  best_prob = mask_pred.max(axis=1)
+  order = np.argsort(-best_prob, kind='stable')
+  confident = [i for i in order if best_prob[i] >= fill_threshold]
+  if pred_i not in confident:
+    confident.insert(0, pred_i)
+  return [(mask_pos[i], mask_pred[i].argmax()) for i in confident]
+
+
+def _restoration_saliency_results(text_char, text_word, padding, char_pos,
+                                  char_idx, text_len, forward, params,
+                                  alphabet, rng):
+  """Saliency maps of restored characters, for a batch of restoration steps.
+
+  Args:
+    text_char: [steps, length] characters after each step's character is set.
+    text_word: [steps, length] words before each step's character is set.
+    padding: [steps, length] padding mask before each step.
+    char_pos: [steps] position restored at each step.
+    char_idx: [steps] character restored at each step.
+    text_len: length of the text.
+    forward: model forward function.
+    params: model parameters.
+    alphabet: GreekAlphabet instance.
+    rng: JAX PRNGKey passed to the model.
+
+  Returns:
+    A list with a SequentialRestorationSaliencyResult per step.
+  """
+  # Gradients for saliency map
+  text_char_emb, text_word_emb = embed(params, text_char, text_word)
+
+  gradient_mask_char, gradient_mask_word = jax.grad(
+      saliency_loss_mask, (1, 2))(
+          forward,
+          text_char_emb,
+          text_word_emb,
+          padding,
+          rng=rng,
+          char_pos=char_pos,
+          char_idx=char_idx)
+
+  # Use gradient x input for visualizing saliency
+  input_grad_mask_char = np.multiply(gradient_mask_char, text_char_emb)
+  input_grad_mask_word = np.multiply(gradient_mask_word, text_word_emb)
+  input_grad_mask = np.clip(input_grad_mask_char + input_grad_mask_word, 0, 1)
+
+  results = []
+  for i in range(text_char.shape[0]):
+    # Return visualization-ready saliency maps
+    saliency_map = grad_to_saliency_char(
+        input_grad_mask[i:i + 1], text_char[i:i + 1], [text_len],
+        alphabet)  # normalize, etc.
+    result_text = idx_to_text(text_char[i], alphabet, strip_sos=False)  # no pad
+
+    results.append(
+        SequentialRestorationSaliencyResult(
+            text=result_text[1:],
+            pred_char_pos=char_pos[i] - 1,
+            saliency_map=saliency_map[1:]))
+  return results
+
+
 def sequential_restoration_saliency(text_str, text_len, forward, params,
                                     alphabet, mask_idx, vocab_char_size,
                                     vocab_word_size):
   """Greedily, non-sequentially restores, producing per-step saliency maps."""
+  del vocab_char_size, vocab_word_size  # Unused, embeddings are gathered.
   text_len = text_len[0] if not isinstance(text_len, int) else text_len
   rng = jax.random.PRNGKey(0)  # dummy, no randomness in model
   mask_idx = set(mask_idx)
+  tokens = TokenState.from_text(text_str, alphabet)
   while mask_idx:
-    text_char = text_to_idx(text_str, alphabet).reshape(1, -1)
-    padding = jnp.where(text_char > 0, 1, 0)
-    text_word = text_to_word_idx(text_str, alphabet).reshape(1, -1)
-
-    _, _, mask_logits, _ = forward(
-        text_char=text_char,
-        text_word=text_word,
-        text_char_onehot=None,
-        text_word_onehot=None,
-        rngs={'dropout': rng},
-        is_training=False)
-    mask_pred = jax.nn.softmax(mask_logits)[0, :text_len]
-    mask_pred_argmax = np.dstack(
-        np.unravel_index(np.argsort(-mask_pred.ravel()), mask_pred.shape))[0]
-
-    # Greedily, non-sequentially take the next highest probability prediction
-    # out of the characters that are to be restored
-    for i in range(mask_pred_argmax.shape[0]):
-      pred_char_pos, pred_char_idx = mask_pred_argmax[i]
-      if pred_char_pos in mask_idx:
-        break
+    text_word = tokens.text_word.reshape(1, -1)
+    padding = np.where(tokens.text_char > 0, 1, 0).reshape(1, -1)
+    pred_char_pos, pred_char_idx = _greedy_restoration_step(
+        forward, tokens, text_len, mask_idx, rng)
 
     # Update sequence
-    text_char[0, pred_char_pos] = pred_char_idx
-    text_str = idx_to_text(
-        text_char[0], alphabet, strip_sos=False, strip_pad=False)
+    tokens = tokens.fill(pred_char_pos, pred_char_idx)
     mask_idx.remove(pred_char_pos)
 
-    # Gradients for saliency map
-    text_char_onehot = jax.nn.one_hot(text_char,
-                                      vocab_char_size).astype(jnp.float32)
-    text_word_onehot = jax.nn.one_hot(text_word,
-                                      vocab_word_size).astype(jnp.float32)
-
-    text_char_emb = jnp.matmul(text_char_onehot,
-                               params['params']['char_embeddings']['embedding'])
-    text_word_emb = jnp.matmul(text_word_onehot,
-                               params['params']['word_embeddings']['embedding'])
-
-    gradient_mask_char, gradient_mask_word = jax.grad(
-        saliency_loss_mask, (1, 2))(
-            forward,
-            text_char_emb,
-            text_word_emb,
-            padding,
-            rng=rng,
-            char_pos=pred_char_pos,
-            char_idx=pred_char_idx)
-
-    # Use gradient x input for visualizing saliency
-    input_grad_mask_char = np.multiply(gradient_mask_char, text_char_emb)
-    input_grad_mask_word = np.multiply(gradient_mask_word, text_word_emb)
-
-    # Return visualization-ready saliency maps
-    saliency_map = grad_to_saliency_char(
-        np.clip(input_grad_mask_char + input_grad_mask_word, 0, 1),
-        text_char_onehot, [text_len], alphabet)  # normalize, etc.
-    result_text = idx_to_text(text_char[0], alphabet, strip_sos=False)  # no pad
-
-    yield SequentialRestorationSaliencyResult(
-        text=result_text[1:],
-        pred_char_pos=pred_char_pos - 1,
-        saliency_map=saliency_map[1:])
+    yield _restoration_saliency_results(
+        tokens.text_char.reshape(1, -1), text_word, padding,
+        np.array([pred_char_pos]), np.array([pred_char_idx]), text_len,
+        forward, params, alphabet, rng)[0]
+
+
+def batched_restoration_saliency(
+    text_str,
+    text_len,
+    forward,
+    params,
+    alphabet,
+    mask_idx,
+    batch_size=16,
+    fill_threshold=None) -> List[SequentialRestorationSaliencyResult]:
+  """Same results as `sequential_restoration_saliency`, with batched gradients.
+
+  The greedy restoration order is found first, with one forward pass per
+  missing character. The saliency gradients of all intermediate texts are then
+  computed together, `batch_size` steps per backward pass.
+
+  With `fill_threshold`, each forward pass also restores all characters that
+  are predicted with at least that probability, as `beam_search_parallel_fill`
+  does; the results then only approximate the greedy restoration.
+  """
+  text_len = text_len[0] if not isinstance(text_len, int) else text_len
+  rng = jax.random.PRNGKey(0)  # dummy, no randomness in model
+  mask_idx = set(mask_idx)
+  tokens = TokenState.from_text(text_str, alphabet)
+  text_char, text_word, padding, char_pos, char_idx = [], [], [], [], []
+  while mask_idx:
+    predictions = _greedy_restoration_step(forward, tokens, text_len, mask_idx,
+                                           rng, fill_threshold)
+    if fill_threshold is None:
+      predictions = [predictions]
+
+    # Record the characters one at a time, as if restored sequentially.
+    for pred_char_pos, pred_char_idx in predictions:
+      text_word.append(tokens.text_word)
+      padding.append(np.where(tokens.text_char > 0, 1, 0))
+
+      # Update sequence
+      tokens = tokens.fill(pred_char_pos, pred_char_idx)
+      mask_idx.remove(pred_char_pos)
+      text_char.append(tokens.text_char)
+      char_pos.append(pred_char_pos)
+      char_idx.append(pred_char_idx)
+
+  results = []
+  for start in range(0, len(char_pos), batch_size):
+    end = start + batch_size
+    results.extend(
+        _restoration_saliency_results(
+            np.stack(text_char[start:end]), np.stack(text_word[start:end]),
+            np.stack(padding[start:end]), np.array(char_pos[start:end]),
+            np.array(char_idx[start:end]), text_len, forward, params,
+            alphabet, rng))
+  return results
@@ -15,37 +15,100 @@
 
 import random
 import re
+import threading
 import unicodedata
+import weakref
 
 import numpy as np
 
 
+class _CharLookup:
+  """Lookup tables between characters (as code points) and their indices."""
+
+  def __init__(self, alphabet):
+    self.char2idx = alphabet.char2idx
+    self.idx2char = alphabet.idx2char
+    # -1 marks code points that are not in the alphabet.
+    self.encode = np.full(
+        max(map(ord, alphabet.char2idx)) + 1, -1, dtype=np.int32)
+    for c, idx in alphabet.char2idx.items():
+      self.encode[ord(c)] = idx
+    # Decoding takes the code points of all characters at once, which needs
+    # single-character entries; otherwise their strings are joined.
+    self.single_chars = all(len(c) == 1 for c in alphabet.idx2char)
+    self.decode = np.array(
+        [ord(c) if len(c) == 1 else 0 for c in alphabet.idx2char],
+        dtype='<u4')
+    self.sos = alphabet.idx2char[alphabet.sos_idx]
+
+
+_char_lookups = weakref.WeakKeyDictionary()
+_char_lookups_lock = threading.Lock()
+
+
+def _get_char_lookup(alphabet):
+  with _char_lookups_lock:
+    lookup = _char_lookups.get(alphabet)
+    if (lookup is None or lookup.char2idx is not alphabet.char2idx or
+        lookup.idx2char is not alphabet.idx2char):
+      lookup = _CharLookup(alphabet)
+      _char_lookups[alphabet] = lookup
+  return lookup
+
+
+def _decode(idxs, lookup):
+  """Returns the string of all characters of an index array, in order."""
+  if not idxs.size:
+    return ''
+  if lookup.single_chars:
+    return np.take(lookup.decode, idxs).tobytes().decode('utf-32-le')
+  return ''.join(np.take(lookup.idx2char, idxs).ravel().tolist())
+
+
 def idx_to_text(idxs, alphabet, strip_sos=True, strip_pad=True):
   """Converts a list of indices to a string."""
-  idxs = np.array(idxs)
-  out = ''
-  for i in range(idxs.size):
-    idx = idxs[i]
-    if strip_pad and idx == alphabet.pad_idx:
-      break
-    elif strip_sos and idx == alphabet.sos_idx:
-      pass
-    else:
-      out += alphabet.idx2char[idx]
+  idxs = np.asarray(idxs).ravel()
+  if strip_pad:
+    pad = np.flatnonzero(idxs == alphabet.pad_idx)
+    if pad.size:
+      idxs = idxs[:pad[0]]
+  if strip_sos:
+    idxs = idxs[idxs != alphabet.sos_idx]
+  return _decode(idxs, _get_char_lookup(alphabet))
+
+
+def idx_to_text_batch(idxs,
+                      alphabet,
+                      lengths=None,
+                      strip_sos=True,
+                      strip_pad=True):
+  """Converts batched lists of indices to strings.
+
+  All rows are decoded together, as `idx_to_text` decodes each of them.
+  """
+  idxs = np.asarray(idxs)
+  batch_size, length = idxs.shape
+  ends = np.full(batch_size, length)
+  if lengths is not None:
+    ends = np.minimum(ends, lengths)
+  if strip_pad and length:
+    is_pad = idxs == alphabet.pad_idx
+    ends = np.minimum(ends, np.where(is_pad.any(1), is_pad.argmax(1), length))
+  lookup = _get_char_lookup(alphabet)
+  if not lookup.single_chars:
+    # Rows cannot be sliced out of the joined string.
+    return [
+        idx_to_text(idxs[i, :ends[i]], alphabet, strip_sos, strip_pad=False)
+        for i in range(batch_size)
+    ]
+  text = _decode(idxs, lookup)
+  out = []
+  for i, end in enumerate(ends.tolist()):
+    row = text[i * length:i * length + end]
+    out.append(row.replace(lookup.sos, '') if strip_sos else row)
   return out
 
 
-def idx_to_text_batch(idxs, alphabet, lengths=None):
-  """Converts batched lists of indices to strings."""
-  b = []
-  for i in range(idxs.shape[0]):
-    idxs_i = idxs[i]
-    if lengths:
-      idxs_i = idxs_i[:lengths[i]]
-    b.append(idx_to_text(idxs_i, alphabet))
-  return b
-
-
 def random_mask_span(t, geometric_p=0.2, limit_chars=None):
   """Masks a span of sequential words."""
 
@@ -165,15 +228,53 @@ def random_word_swap(sentence, p):
   return sentence
 
 
+class _StripMarks(dict):
+  """`str.translate` table deleting nonspacing marks (category Mn).
+
+  Entries are computed on first use of each code point, so the table holds
+  just the characters seen, e.g. the Greek letters and their diacritics.
+  """
+
+  def __missing__(self, codepoint):
+    value = None if unicodedata.category(chr(codepoint)) == 'Mn' else codepoint
+    self[codepoint] = value
+    return value
+
+
+_strip_marks = _StripMarks()
+
+
 def strip_accents(s):
-  return ''.join(
-      c for c in unicodedata.normalize('NFD', s)
-      if unicodedata.category(c) != 'Mn')
+  return unicodedata.normalize('NFD', s).translate(_strip_marks)
 
 
 def text_to_idx(t, alphabet):
-  """Converts a string to character indices."""
-  return np.array([alphabet.char2idx[c] for c in t], dtype=np.int32)
+  """Converts a string to character indices.
+
+  Raises:
+    KeyError: for a character that is not in the alphabet.
+  """
+  lookup = _get_char_lookup(alphabet)
+  codepoints = np.frombuffer(t.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+  idxs = np.take(lookup.encode, codepoints, mode='clip')
+  unknown = (idxs < 0) | (codepoints >= len(lookup.encode))
+  if unknown.any():
+    raise KeyError(t[np.argmax(unknown)])
+  return idxs
+
+
+def text_to_idx_batch(ts, alphabet):
+  """Converts strings to a [batch, length] array of character indices.
+
+  Strings shorter than the longest one are padded with `alphabet.pad_idx`.
+  """
+  lengths = np.array([len(t) for t in ts], dtype=np.int64)
+  out = np.full((len(ts), lengths.max(initial=0)),
+                alphabet.pad_idx,
+                dtype=np.int32)
+  out[np.arange(out.shape[1]) < lengths[:, None]] = text_to_idx(
+      ''.join(ts), alphabet)
+  return out
 
 
 def text_to_word_idx(t, alphabet):
@@ -184,3 +285,106 @@ def text_to_word_idx(t, alphabet):
       out[m.start():m.end()] = alphabet.word2idx[m.group()]
   return out
 
+
+class _WordLookup:
+  """Word indices keyed by the bytes of the word's character indices."""
+
+  def __init__(self, alphabet):
+    self.word2idx = alphabet.word2idx
+    self.unk_idx = alphabet.word2idx[alphabet.unk]
+    self.is_word = np.array(
+        [bool(re.match(r'\w', c)) for c in alphabet.idx2char])
+    self.index = {}
+    for word, idx in alphabet.word2idx.items():
+      if word and all(c in alphabet.char2idx for c in word):
+        self.index[text_to_idx(word, alphabet).tobytes()] = idx
+
+
+_word_lookups = weakref.WeakKeyDictionary()
+_word_lookups_lock = threading.Lock()
+
+
+def _get_word_lookup(alphabet):
+  with _word_lookups_lock:
+    lookup = _word_lookups.get(alphabet)
+    # The word list may be replaced after construction, e.g. by a checkpoint's.
+    if lookup is None or lookup.word2idx is not alphabet.word2idx:
+      lookup = _WordLookup(alphabet)
+      _word_lookups[alphabet] = lookup
+  return lookup
+
+
+class TokenState:
+  """Character and word indices of a text that is restored in place.
+
+  Filling in one character only changes the word containing it, so `fill`
+  re-tokenizes just that word's span instead of the whole text. Words are the
+  `\\w+` runs of `text_to_word_idx`; `word_start` and `word_end` hold the
+  (inclusive) span of the word at every word position.
+  """
+
+  def __init__(self, alphabet, text_char, text_word, word_start, word_end):
+    self.alphabet = alphabet
+    self.text_char = text_char
+    self.text_word = text_word
+    self.word_start = word_start
+    self.word_end = word_end
+
+  @classmethod
+  def from_text(cls, t, alphabet):
+    """Tokenizes a string, as `text_to_idx` and `text_to_word_idx` do."""
+    lookup = _get_word_lookup(alphabet)
+    text_char = text_to_idx(t, alphabet)
+    pos = np.arange(len(text_char))
+    is_word = lookup.is_word[text_char]
+    prev_word = np.concatenate([[False], is_word[:-1]])
+    next_word = np.concatenate([is_word[1:], [False]])
+    word_start = np.maximum.accumulate(np.where(is_word & ~prev_word, pos, 0))
+    word_end = np.minimum.accumulate(
+        np.where(is_word & ~next_word, pos, len(pos) - 1)[::-1])[::-1]
+    return cls(alphabet, text_char, text_to_word_idx(t, alphabet),
+               word_start.astype(np.int32), word_end.astype(np.int32))
+
+  def copy(self):
+    return TokenState(self.alphabet, self.text_char.copy(),
+                      self.text_word.copy(), self.word_start.copy(),
+                      self.word_end.copy())
+
+  def fill(self, pos, char_idx):
+    """Returns a new state with the character at `pos` set to `char_idx`."""
+    state = self.copy()
+    state.fill_(pos, char_idx)
+    return state
+
+  def fill_(self, pos, char_idx):
+    """In-place version of `fill`."""
+    lookup = _get_word_lookup(self.alphabet)
+    is_word = lookup.is_word
+    length = len(self.text_char)
+    was_word = is_word[self.text_char[pos]]
+    self.text_char[pos] = char_idx
+
+    if was_word:
+      start, end = self.word_start[pos], self.word_end[pos]
+    else:
+      start = end = pos
+      if pos > 0 and is_word[self.text_char[pos - 1]]:
+        start = self.word_start[pos - 1]
+      if pos < length - 1 and is_word[self.text_char[pos + 1]]:
+        end = self.word_end[pos + 1]
+
+    if is_word[char_idx]:
+      self._set_word(start, end, lookup)
+    else:
+      self.text_word[pos] = lookup.unk_idx
+      if start < pos:
+        self._set_word(start, pos - 1, lookup)
+      if pos < end:
+        self._set_word(pos + 1, end, lookup)
+
+  def _set_word(self, start, end, lookup):
+    span = slice(start, end + 1)
+    self.word_start[span] = start
+    self.word_end[span] = end
+    self.text_word[span] = lookup.index.get(self.text_char[span].tobytes(),
+                                            lookup.unk_idx)
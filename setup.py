@@ -42,6 +42,9 @@ setuptools.setup(
             'tensorflow-datasets',
         ]
     },
+    entry_points={
+        'console_scripts': ['ithaca-batch=ithaca.eval.batch:run'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',